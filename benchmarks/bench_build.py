@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of tokenize() + ExpBuilder: time per token should stay flat while the
+expression grows, i.e. building the syntax tree is linear in its length.
+
+    python benchmarks/bench_build.py
+"""
+
+import gc, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fatexpression
+
+
+def flat(n):
+    return '+'.join('(a%d*2.5-b%d/3)' % (i, i) for i in range(n))
+
+def nested(n):
+    return 'x(' * n + '1' + ',2)' * n
+
+def measure(expression, repeat=3):
+    """Best time of tokenizing and building; the collector is paused to time the parser alone"""
+    best = None
+    for i in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.time()
+            tokens = list(fatexpression.tokenize(expression))
+            fatexpression.ExpBuilder(expression, tokens).build()
+            elapsed = time.time() - start
+        finally:
+            gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(tokens)
+
+def main():
+    sys.setrecursionlimit(100000)
+    for name, generator, sizes in [('flat', flat, [500, 1000, 2000, 4000, 8000]),
+                                   ('nested', nested, [250, 500, 1000, 2000])]:
+        print('%-8s %10s %10s %14s' % (name, 'tokens', 'seconds', 'us/token'))
+        for size in sizes:
+            elapsed, tokens = measure(generator(size))
+            print('%-8s %10d %10.4f %14.3f' % ('', tokens, elapsed, elapsed * 1e6 / tokens))
+
+if __name__ == '__main__':
+    main()
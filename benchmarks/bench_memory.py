@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""
+Memory benchmark of compiled syntax trees: bytes allocated per node while
+building many distinct rules, and how many of those bytes the cyclic garbage
+collector still has to free once the trees are dropped.
+
+The trees are measured twice: as built now and copied into the layout nodes
+had before they were compacted (attributes in a __dict__, a parent pointer,
+a list of tokens per node and lists of children), so the reduction can be
+reproduced.
+
+    python benchmarks/bench_memory.py
+"""
+
+import gc, os, sys, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fatexpression
+
+
+class LegacyToken:
+    """Token as kept by the nodes before they were compacted"""
+    def __init__(self, tokenText, tokenType):
+        self.tokenText = tokenText
+        self.tokenType = tokenType
+
+class LegacyNode:
+    """Node before it was compacted: expression text, parent and token list"""
+    def __init__(self, expression, parentNode, tokens):
+        self.expression = expression
+        self.parent     = parentNode
+        self.tokens     = tokens
+        self.childLeft  = []
+        self.childRight = []
+
+
+def rules(n):
+    for i in range(n):
+        yield 'if(a%d>%d, x(b,%d.5)*2, max(c,d)-%d)+sqrt(e^2+f^2)' % (i % 50, i, i, i)
+
+def nodes(tree):
+    return sum(1 for node in tree.walk())
+
+def legacy(node, expression, parent=None):
+    """Copy of the tree of node in the layout before compaction; the token text is a
+    new string, as the tokenizer sliced it from the expression"""
+    result = LegacyNode(expression, parent, [LegacyToken(''.join(node.text), node.opcode)])
+    result.childLeft = [legacy(child, expression, result) for child in node.childLeft]
+    result.childRight = [legacy(child, expression, result) for child in node.childRight]
+    return result
+
+def measure(build):
+    """Bytes allocated by build() and left for the collector once its result is dropped"""
+    gc.collect()
+    gc.disable()
+    try:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        trees = build()
+        after = tracemalloc.get_traced_memory()[0]
+
+        del trees
+        freed = tracemalloc.get_traced_memory()[0]
+        collected = gc.collect()
+        tracemalloc.stop()
+    finally:
+        gc.enable()
+    return after - before, freed - before, collected
+
+def report(title, total, measured):
+    allocated, left, collected = measured
+    print(title)
+    print('  bytes per node:   %.1f' % (float(allocated) / total))
+    print('  left for the gc:  %.1f bytes per node (%d objects)' % (float(left) / total, collected))
+
+def main(count=20000):
+    texts = list(rules(count))
+    trees = [fatexpression.buildTree(text) for text in texts]
+    total = sum(nodes(tree) for tree in trees)
+
+    print('rules:            %d' % count)
+    print('nodes:            %d' % total)
+    def build():
+        return [legacy(tree, text) for tree, text in zip(trees, texts)]
+
+    report('before (legacy layout):', total, measure(build))
+    trees = None
+    report('now:', total, measure(lambda: [fatexpression.buildTree(text) for text in texts]))
+
+if __name__ == '__main__':
+    main()
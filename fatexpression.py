@@ -111,7 +111,19 @@ features
 
 """
 
-import math, string, random
+import argparse, asyncio, csv, inspect, json, math, mmap, os, random, re, struct, sys, threading, time, zlib
+from sys import intern
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import reduce
+from itertools import islice, repeat
+from types import MappingProxyType
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 __version__ = "1.0"
 __versionTime__ = "09 mar 2014 22:22"
@@ -119,7 +131,6 @@ __author__ = "Allan Lima <allan.kardek@gmail.com>"
 
 ERROR_CHARACTER_ILLEGAL = 'Parse error: illegal character "%s".'
 ERROR_STRING_OPEN = 'Parse error: text string not close'
-ERROR_CALCULATE_SYNTAX = 'Calculate error: syntax tree fault. Token: "%s"'
 ERROR_COMPILE_SYNTAX =  'Compile error: syntax fault.'
 ERROR_UNDECLARED = 'Undeclared identifier: "%s"'
 ERROR_FUNCTION_PARSE = 'Function "%s" parse error.'
@@ -129,8 +140,22 @@ ERROR_FUNCTION_HEADER = 'Function header "%s" is not valid.'
 ERROR_FUNCTION_DELIMITOR = ERROR_FUNCTION_PARSE + ': delimitor "%s" expected between arguments.'
 ERROR_FUNCTION_CLOSE = ERROR_FUNCTION_PARSE + ': parenthesis close expected.'
 ERROR_FUNCTION_TYPE = ERROR_FUNCTION_PARSE + ': argurment expected type string.'
+ERROR_FUNCTION_DUPLICATE = 'Function "%s" already declared.'
+ERROR_FUNCTION_CYCLIC = 'Function "%s" is cyclic: %s.'
+ERROR_FUNCTION_IMPURE = 'Function "%s" is not pure: %s.'
 ERROR_FUNCTION_PARENTHESIS = 'Compile error: parenthesis mismatch. Expression: %s'
-ERROR_TOKEN_LIST = 'Tokens list error.'
+ERROR_BATCH_COLUMNS = 'Batch error: columns must have the same length.'
+ERROR_NUMPY = 'NumPy is required for vectorized evaluation.'
+ERROR_PROGRAM_OPCODE = 'Program error: invalid opcode %d.'
+ERROR_INCREMENTAL_MODE = 'Incremental evaluation requires evaluateMode emTree.'
+ERROR_COMPILED_READONLY = 'Compiled expression is read-only: "%s".'
+ERROR_PACK_FORMAT = 'Pack error: "%s" is not a rule pack.'
+ERROR_PACK_VERSION = 'Pack error: format version %d, expected %d.'
+ERROR_PACK_CHECKSUM = 'Pack error: checksum mismatch in "%s".'
+ERROR_PACK_EXPRESSION = 'Pack error: expression "%s" not found.'
+ERROR_RULE_TEXT = 'Rule "%s" must be one expression without assignments or _.'
+ERROR_RULE_DUPLICATE = 'Rule "%s" already declared.'
+ERROR_RULE_NAME = 'Rule "%s" not found.'
 
 STR_OPERATION = '*/^%+-!~'  # supported operations numeric
 STR_RELATION  = '<>=<='     # supported operations relation
@@ -145,10 +170,82 @@ A_OPERATION = ['/', '-+', '*%^', '~!']
 ttNone, ttOldValue, ttNumeric, ttOperation, ttString, ttParamDelimitor, \
 ttParenthesisOpen, ttParenthesisClose, ttRelation, ttBoolean = range(10)
 
+opNone, opNumeric, opOldValue, opTrue, opFalse, opIdentifier, \
+opAdd, opSubtract, opMultiply, opDivide, opPower, opModule, opFactorial, opNegate, opNot, \
+opAnd, opOr, opXor, \
+opGreater, opLess, opGreaterEqual, opLessEqual, opDifferent, opEqual = range(24)
+
+# opcodes of ExpProgram; opLocal and opStore also read and keep shared subtrees (see ExpOptimizer)
+opLocal, opArgument, opCall, opCallFunction, opStore, opLine, opJump, opJumpFalse, opJumpTrue, \
+    opCallNative = range(24, 34)
+
+# identifier resolved to an input variable (see ExpResolver); opLocal, opArgument, opCall,
+# opCallFunction and opCallNative are the other resolved identifiers
+opVariable = 34
+
+# rule packs (see savePack): magic, format version, reserved, crc32 of the rest of the file,
+# offset and size of the JSON directory; the arrays of the programs follow, 8-byte aligned
+PACK_MAGIC = b'FXPK'
+PACK_VERSION = 1
+PACK_HEADER = struct.Struct('<4sHHIQQ')
+
+# opcode of the operation tokens; unary minus is opNegate
+OPCODES = {
+    '+': opAdd, '-': opSubtract, '*': opMultiply, '/': opDivide, '^': opPower, '%': opModule,
+    '!': opFactorial, '~': opNot, '&': opAnd, '|': opOr, '?': opXor,
+    '>': opGreater, '<': opLess, '>=': opGreaterEqual, '<=': opLessEqual, '=<': opLessEqual,
+    '<>': opDifferent, '=': opEqual,
+}
+
 eoInternalFirst, eoEventFirst = 0, 1
 
-class ExpToken:
+# evaluateMode: syntax-tree walker, generated Python function, stack-machine program
+emTree, emCode, emProgram = 0, 1, 2
+
+def _priority(text, groups):
+    for i, group in enumerate(groups):
+        p = group.find(text)
+        if p > -1:
+            return (i+1)*10 + p
+    return -1
+
+# booleans are calculated after relations, relations after operations
+PRIORITIES = {
+    ttBoolean: dict((text, _priority(text, A_BOOLEAN)) for text in A_BOOLEAN),
+    ttRelation: {},
+    ttOperation: dict((text, 1000 + _priority(text, A_OPERATION)) for text in STR_OPERATION),
+}
+for _i in range(len(STR_RELATION)):
+    for _text in (STR_RELATION[_i], STR_RELATION[_i:_i+2]):
+        PRIORITIES[ttRelation][_text] = 100
+PREFIX_OPERATIONS = ('-', '~')   # where an operand is expected
+POSTFIX_OPERATIONS = ('!',)
+
+# one alternative per token type, tried at each position after the spaces
+TOKEN_RULES = [
+    (ttNumeric, r'[0-9.]+'),
+    (ttString, r'[A-Za-z][A-Za-z0-9.]*'),
+    (ttRelation, '|'.join(re.escape(STR_RELATION[i:i+2]) for i in range(len(STR_RELATION)-1)) +
+                 '|[%s]' % re.escape(STR_RELATION)),
+    (ttOperation, '[%s]' % re.escape(STR_OPERATION)),
+    (ttParenthesisOpen, '[%s]' % re.escape(STR_PARENTHESIS_OPEN)),
+    (ttParenthesisClose, '[%s]' % re.escape(STR_PARENTHESIS_CLOSE)),
+    (ttBoolean, '[%s]' % re.escape(''.join(A_BOOLEAN))),
+    (ttParamDelimitor, '%s+' % re.escape(STR_PARAMDELIMITOR)),
+    (ttOldValue, '%s+' % re.escape(STR_OLD_VALUE)),
+    (ttNone, '[^ ]'),  # illegal character
+]
+TOKEN_PATTERN = re.compile(' *(?:%s)' % '|'.join('(%s)' % rule for tokenType, rule in TOKEN_RULES))
+TOKEN_TYPES = [ttNone] + [tokenType for tokenType, rule in TOKEN_RULES]  # by group index
+
+# builtins calculating only the arguments they need
+LAZY_FUNCTIONS = ('if', 'and', 'or')
+
+
+class ExpToken(object):
     """Class used by TExpParser and TExpNode for breaking text into tokens and building a syntax tree"""
+    __slots__ = ('tokenText', 'tokenType')
+
     def __init__(self, tokenText='', tokenType=ttNone):
         self.tokenText = tokenText
         self.tokenType = tokenType
@@ -201,33 +298,6 @@ class ExpParser:
     def _getToken(self, index):
         return self.tokens[index]
 
-    def _getTokenType(self, s, first):
-        if s == STR_PARAMDELIMITOR:
-            return ttParamDelimitor
-        elif STR_OPERATION.find(s) > -1:
-            return ttOperation
-        elif s in STR_PARENTHESIS_OPEN:
-            return ttParenthesisOpen
-        elif s in STR_PARENTHESIS_CLOSE:
-            return ttParenthesisClose
-        elif STR_RELATION.find(s) > -1:
-            return ttRelation
-        elif s in A_BOOLEAN:
-            return ttBoolean
-        elif s in string.digits+'.':
-            return ttNumeric
-        elif s == STR_OLD_VALUE:
-            return ttOldValue
-        else: # legal variable name characters
-            if first:
-                p = string.ascii_letters.find(s)
-            else:
-                p = (string.ascii_letters+string.digits).find(s)
-            if p > -1:
-                return ttString
-            else:
-                return ttNone
-
     def findVariable(self, name):
         name = name.strip().lower()
         if name in self._variables:
@@ -240,55 +310,45 @@ class ExpParser:
 
     def readNextToken(self):
 
-        def createToken(tokenText):
-            token = ExpToken(tokenText, firstType)
-            self._tokens.append(token)
-            return token
+        match = TOKEN_PATTERN.match(self.expression, self._pos)
 
-        if self._pos > len(self.expression)-1:
+        if match is None:
             return None
 
-        while 1:
-            ch = self.expression[self._pos]
-            self._pos += 1
-            if ch != ' ' or self._pos > len(self.expression)-1:
-                break
-
-        firstType = self._getTokenType(ch, True)
+        if TOKEN_TYPES[match.lastindex] == ttNone:
+            raise Exception(ERROR_CHARACTER_ILLEGAL % match.group(match.lastindex))
 
-        if firstType == ttNone:
-            raise Exception(ERROR_CHARACTER_ILLEGAL % ch)
+        self._pos = match.end()
 
-        if firstType in [ttOperation, ttParenthesisOpen, ttParenthesisClose, ttBoolean]:
-            return createToken(ch)
+        token = ExpToken(match.group(match.lastindex), TOKEN_TYPES[match.lastindex])
+        self._tokens.append(token)
+        return token
 
-        if firstType == ttRelation:
+    def iterTokens(self):
+        """Breaks the expression into tokens and validates the brackets in one pass"""
 
-            if self._pos < len(self.expression):
-                part = ch
-                ch   = self.expression[self._pos]
-                nextType = self._getTokenType(ch, False)
-
-                if firstType == nextType and firstType == ttRelation and STR_RELATION.find(part+ch) > -1:
-                    self._pos += 1
-                    part = part + ch
-
-            return createToken(part)
+        expression = self.expression
+        pilha = []
 
-        part = ch
+        for m in TOKEN_PATTERN.finditer(expression):
 
-        while self._pos < len(self.expression):
-            ch       = self.expression[self._pos]
-            nextType = self._getTokenType(ch, False)
+            tokenType = TOKEN_TYPES[m.lastindex]
+            tokenText = m.group(m.lastindex)
 
-            if (nextType == firstType) or (firstType == ttString and nextType == ttNumeric):
-                part += ch
-            else:
-                return createToken(part)
+            if tokenType == ttNone:
+                raise Exception(ERROR_CHARACTER_ILLEGAL % tokenText)
+            elif tokenType == ttParenthesisOpen:
+                pilha.append(tokenText)
+            elif tokenType == ttParenthesisClose:
+                if len(pilha) == 0:
+                    raise Exception(ERROR_COMPILE_SYNTAX)
+                if pilha.pop() != STR_PARENTHESIS_OPEN[STR_PARENTHESIS_CLOSE.find(tokenText)]:
+                    raise Exception(ERROR_FUNCTION_PARENTHESIS % expression)
 
-            self._pos += 1
+            yield ExpToken(tokenText, tokenType)
 
-        return createToken(part)
+        if len(pilha) > 0:
+            raise Exception(ERROR_COMPILE_SYNTAX)
 
     def readFirstToken(self):
         self._tokens = []
@@ -296,319 +356,618 @@ class ExpParser:
         return self.readNextToken()
 
 
-class ExpNode:
-    """syntax-tree node. this engine uses a bit upgraded binary-tree"""
-    def __init__(self, owner, parentNode, tokens):
-        self.owner  = owner
-        self.parent = parentNode
+class ExpNode(object):
+    """syntax-tree node. this engine uses a bit upgraded binary-tree
 
-        if parentNode:
-            self.level = parentNode.level + 1
-        else:
-            self.level = 0
+    The opcode is resolved when parsing. value is the float of a numeric literal
+    or the lowercase name of an identifier, whose arguments are in childRight.
+    Nodes keep no reference to their parent or owner, so a tree is freed by
+    reference counting and can be shared between FatExpression objects.
+    """
+    __slots__ = ('opcode', 'text', 'value', 'childLeft', 'childRight')
 
-        self.tokens     = tokens[:]
-        self.childLeft  = []
-        self.childRight = []
+    def __init__(self, opcode, text, value=None, childLeft=(), childRight=()):
+        self.opcode     = opcode
+        self.text       = text
+        self.value      = value
+        self.childLeft  = childLeft
+        self.childRight = childRight
 
-    @property
-    def tokenCount(self):
-        return len(self.tokens)
+    def __repr__(self):
+        return '<ExpNode: %s>' % self.text
 
-    @property
-    def token(self):
-        if self.tokenCount > 1:
-            raise Exception(ERROR_TOKEN_LIST)
-        return self.tokens[0]
+    def walk(self):
+        """Iterates this node and all descendants"""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.childRight))
+            stack.extend(reversed(node.childLeft))
 
-    def _removeSorroundingParenthesis(self):
+    def evaluate(self, owner, name=None):
 
-        iFirst = 0
-        iLast  = self.tokenCount - 1
+        if name is None:
+            name = self.value
 
-        while iLast > iFirst:
+        if name in LAZY_FUNCTIONS:
+            result = owner.evaluateLazy(name, self.childRight)
+            if result is not None:
+                return result
 
-            if (self.tokens[iFirst].tokenType == ttParenthesisOpen) and (self.tokens[iLast].tokenType == ttParenthesisClose):
+        args = [node.calculate(owner) for node in self.childRight]
 
-                iLevel = i = 0
-                bSorrounding = True
+        result = owner.evaluate(name, args)
 
-                while 1:
+        if result is None:
+            raise Exception(ERROR_UNDECLARED % self.text)
 
-                    if self.tokens[i].tokenType == ttParenthesisOpen:
-                        iLevel += 1
-                    elif self.tokens[i].tokenType == ttParenthesisClose:
-                        iLevel -= 1
+        return result
 
-                    if iLevel == 0 and i < self.tokenCount-1:
-                        bSorrounding = False
-                        break
+    def call(self, owner):
+        """Calculates an identifier resolved to a function or callback; value is (name, target)"""
 
-                    i += 1
+        name, target = self.value
 
-                    if i == self.tokenCount:
-                        break
+        if name in owner.variables:
+            # a variable added after compiling hides the function
+            return self.evaluate(owner, name)
 
-                if bSorrounding:
-                    self.tokens.pop(iLast)
-                    self.tokens.pop(iFirst)
-                else:
-                    return
+        opcode = self.opcode
 
-            else:
-                return
+        if opcode == opCallNative and name in LAZY_FUNCTIONS:
+            return calculateLazy(name, self.childRight, owner)
 
-            iFirst, iLast = 0, self.tokenCount-1
+        args = [node.calculate(owner) for node in self.childRight]
 
-    def _parseFunction(self):
+        if opcode == opCall:
+            result = owner._callEvaluates(name, args)
+            if result is None:
+                raise Exception(ERROR_UNDECLARED % self.text)
+            return result
 
-        if not ( (self.tokenCount > 2) and \
-                 (self.tokens[0].tokenType == ttString) and \
-                 (self.tokens[1].tokenType == ttParenthesisOpen) and \
-                 (self.tokens[-1].tokenType == ttParenthesisClose) ):
-            return False
+        if opcode == opCallFunction:
+            return target.call(args, owner)
+        return target.call(args)
 
-        self.tokens.pop(-1)
-        self.tokens.pop(1)
+    def calculate(self, owner):
 
-        while self.tokenCount > 1:
+        opcode = self.opcode
 
-            lTokens = []
-            iDelimitor = -1
-            iDelimitorLevel = 0
+        if opcode == opNumeric:
+            return self.value
 
-            for i in range(1, self.tokenCount):
-                if self.tokens[i].tokenType == ttParenthesisOpen:
-                    iDelimitorLevel += 1
-                elif self.tokens[i].tokenType == ttParenthesisClose:
-                    iDelimitorLevel -= 1
-                elif self.tokens[i].tokenType == ttParamDelimitor and iDelimitorLevel == 0:
-                    iDelimitor = i - 1
-                    self.tokens.pop(i)
-                    break
+        elif opcode == opVariable:
+            value = owner.variables.get(self.value)
+            if value is None:
+                return self.evaluate(owner)
+            for node in self.childRight:
+                node.calculate(owner)
+            return value
 
-                if iDelimitorLevel < 0:
-                    raise Exception(ERROR_FUNCTION_PARSE % self.tokens[i].tokenText)
+        elif opcode == opCallNative or opcode == opCallFunction or opcode == opCall:
+            return self.call(owner)
 
-            if iDelimitor == -1:
-                iDelimitor = self.tokenCount - 1
+        elif opcode == opArgument:
+            for node in self.childRight:
+                node.calculate(owner)
+            return owner.values[self.value]
 
-            for i in range(1, iDelimitor+1):
-                lTokens.append(self.tokens[1])
-                self.tokens.pop(1)
+        elif opcode == opIdentifier:
+            return self.evaluate(owner)
 
-            child = ExpNode(self.owner, self, lTokens)
-            child.build()
-            self.childRight.append(child)
+        elif opcode == opAdd:
+            return float(self.childLeft[0].calculate(owner)) + float(self.childRight[0].calculate(owner))
 
-        return True
+        elif opcode == opSubtract:
+            return float(self.childLeft[0].calculate(owner)) - float(self.childRight[0].calculate(owner))
 
-    def _splitToChildren(self, tokenIndex):
-
-        iTokenCount = self.tokenCount
-        left  = []
-        rigth = []
-
-        if tokenIndex < iTokenCount - 1:
-            for i in range(iTokenCount-1, tokenIndex, -1):
-                rigth.insert(0, self.tokens[i])
-                self.tokens.pop(i)
-            child = ExpNode(self.owner, self, rigth)
-            self.childRight.insert(0, child)
-            child.build()
-
-        if tokenIndex > 0:
-            for i in range(tokenIndex-1, -1, -1):
-                left.insert(0, self.tokens[i])
-                self.tokens.pop(i)
-            child = ExpNode(self.owner, self, left)
-            self.childLeft.insert(0, child)
-            child.build()
-
-    def _findLSOTI(self):
-        """Least Significant Operation Token Index"""
-        def posArray(substr, aString):
-            result = -1
-            for i, s in enumerate(aString):
-                result = s.find(substr)
-                if result > -1:
-                    return (i+1)*10+result
-            return result
+        elif opcode == opMultiply:
+            return float(self.childLeft[0].calculate(owner)) * float(self.childRight[0].calculate(owner))
 
-        iPriorityBoolean = iPriorityOperation = iPriorityRelation = -1
-        iLevel = iBoolean = iOperation = 0
+        elif opcode == opDivide:
+            return float(self.childLeft[0].calculate(owner)) / float(self.childRight[0].calculate(owner))
 
-        for i in range(self.tokenCount):
+        elif opcode == opPower:
+            return float(self.childLeft[0].calculate(owner)) ** float(self.childRight[0].calculate(owner))
 
-            token = self.tokens[i]
+        elif opcode == opOldValue:
+            return owner._value_old
 
-            if token.tokenType == ttParenthesisOpen:
-                iLevel += 1
-            elif token.tokenType == ttParenthesisClose:
-                iLevel -= 1
+        elif opcode == opLocal:
+            for node in self.childRight:
+                node.calculate(owner)
+            return owner._locals[self.value]
 
-            if iLevel < 0:
-                raise Exception(ERROR_FUNCTION_PARENTHESIS % self.owner.text)
+        elif opcode == opStore:
+            value = self.childRight[0].calculate(owner)
+            owner._locals[self.value] = value
+            return value
 
-            elif iLevel == 0 and token.tokenType == ttBoolean:
-                iNewPriorityBoolean = posArray(token.tokenText, A_BOOLEAN)
-                if iPriorityBoolean == -1 or iNewPriorityBoolean <= iPriorityBoolean:
-                    iPriorityBoolean, iBoolean = iNewPriorityBoolean, i
+        elif opcode == opNegate:
+            return self.childRight[0].calculate(owner)*(-1)
 
-            elif iLevel == 0 and token.tokenType == ttRelation:
-                iPriorityRelation = i
+        elif opcode == opModule:
+            return int(float(self.childLeft[0].calculate(owner))) % int(float(self.childRight[0].calculate(owner)))
 
-            elif iLevel == 0 and token.tokenType == ttOperation:
-                iNewPriorityOperation = posArray(token.tokenText, A_OPERATION)
-                if iPriorityOperation == -1 or iNewPriorityOperation <= iPriorityOperation:
-                    iPriorityOperation, iOperation = iNewPriorityOperation, i
+        elif opcode == opFactorial:
+            return math.factorial(int(float(self.childLeft[0].calculate(owner))))
 
-        if iPriorityBoolean > -1:
-            return iBoolean
-        elif iPriorityRelation > -1:
-            return iPriorityRelation
-        elif iPriorityOperation > -1:
-            return iOperation
-        else:
-            return -1
+        elif opcode == opNot:
+            if int(float(self.childRight[0].calculate(owner))) == 1:
+                return 0
+            return 1
 
-    def build(self):
+        elif opcode == opTrue:
+            return 1
 
-        self._removeSorroundingParenthesis()
+        elif opcode == opFalse or opcode == opNone:
+            return 0
+
+        elif opcode <= opXor:
+            left  = float(self.childLeft[0].calculate(owner))
 
-        if self.tokenCount < 2:
-            return self
+            # & and | calculate the right side only when it decides the result
+            if opcode == opAnd:
+                return 1 if left == 1 and float(self.childRight[0].calculate(owner)) == 1 else 0
+            elif opcode == opOr:
+                return 1 if left == 1 or float(self.childRight[0].calculate(owner)) == 1 else 0
 
-        iLSOTI = self._findLSOTI()
+            rigth = float(self.childRight[0].calculate(owner))
+            return 1 if (left == 1 and rigth == 0) or (left == 0 and rigth == 1) else 0
 
-        if iLSOTI < 0:
-            if not self._parseFunction():
-                raise Exception(ERROR_COMPILE_SYNTAX + '. Expression: '+self.owner.text)
         else:
-            self._splitToChildren(iLSOTI)
+            left  = self.childLeft[0].calculate(owner)
+            rigth = self.childRight[0].calculate(owner)
+
+            if opcode == opGreater:
+                return 1 if left > rigth else 0
+            elif opcode == opLess:
+                return 1 if left < rigth else 0
+            elif opcode == opLessEqual:
+                return 1 if left <= rigth else 0
+            elif opcode == opGreaterEqual:
+                return 1 if left >= rigth else 0
+            elif opcode == opDifferent:
+                return 1 if left != rigth else 0
+            else:
+                return 1 if left == rigth else 0
 
-        return self
+    def asFloat(self, owner):
+        return float(self.calculate(owner))
 
-    def evaluate(self):
 
-        result = None
-        args = []
+class ExpBuilder(object):
+    """Precedence-climbing parser: builds a syntax tree in one pass over the tokens.
 
-        for node in self.childRight:
-            args.append(node.calculate())
+    The priorities (PRIORITIES) are the ones of A_BOOLEAN and A_OPERATION: the
+    lower the priority, the later the operation is calculated, and equal
+    priorities are calculated from left to right. Unary minus has the priority
+    of subtraction and ~ (negation) its own.
+    """
 
-        if isinstance(self.owner, FatExpression):
-            result = self.owner.evaluate(self.token.tokenText, args)
-        elif isinstance(self.owner, ExpFunction):
-            result = self.owner.evalArgs(self.token.tokenText, args)
+    def __init__(self, expression, tokens):
+        self.expression = expression
+        self.tokens = tokens
+        self.count = len(tokens)
+        self.pos = 0
 
-        if result is None:
-            raise Exception(ERROR_UNDECLARED % self.token.tokenText)
+    def build(self):
+        if self.count == 0:
+            return ExpNode(opNone, '')
 
-        return result
+        node = self.parseExpression(-1)
 
-    def operParamateres(self):
-
-        token = self.token
-        result = True
-
-        if token.tokenType in [ttOperation, ttRelation, ttBoolean]:
-            if token.tokenText == '-' and len(self.childLeft) == 0 and len(self.childRight) == 1:
-                result = True
-            elif token.tokenText == '!': # factorial
-                result = len(self.childLeft) == 1 and len(self.childRight) == 0
-            elif token.tokenText == '~': # negation
-                result = len(self.childLeft) == 0 and len(self.childRight) == 1
-            elif STR_OPERATION.find(token.tokenText) > -1:
-                result = len(self.childLeft) == 1 and len(self.childRight) == 1
-            elif STR_RELATION.find(token.tokenText) > -1:
-                result = len(self.childLeft) == 1 and len(self.childRight) == 1
-            elif  token.tokenText in A_BOOLEAN:
-                result = len(self.childLeft) == 1 and len(self.childRight) == 1
+        if self.pos < self.count:
+            self.error()
 
-        return result
+        return node
 
-    def calculate(self):
+    def error(self):
+        raise Exception(ERROR_COMPILE_SYNTAX + '. Expression: ' + self.expression)
 
-        result = 0
-        if self.tokenCount != 1:
-            return result
+    def next(self):
+        if self.pos >= self.count:
+            self.error()
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def peekType(self):
+        if self.pos < self.count:
+            return self.tokens[self.pos].tokenType
+        return ttNone
+
+    def leaf(self, token, args=()):
+        text = token.tokenText
 
-        token = self.token
+        if token.tokenType == ttNumeric:
+            return ExpNode(opNumeric, text, float(text))
+        elif token.tokenType == ttOldValue:
+            return ExpNode(opOldValue, text)
 
-        if not self.operParamateres():
-            raise Exception(ERROR_CALCULATE_SYNTAX % token.tokenText)
+        name = intern(text.lower())
+        if name == 'true':
+            return ExpNode(opTrue, text)
+        elif name == 'false':
+            return ExpNode(opFalse, text)
+        return ExpNode(opIdentifier, intern(text), name, (), tuple(args))
 
-        if token.tokenType == ttOldValue:
-            result = self.owner._value_old
+    def parseExpression(self, minPriority):
+        left = self.parsePrefix()
 
-        elif token.tokenType == ttNumeric:
-            result = float(token.tokenText)
+        while self.pos < self.count:
+            token = self.tokens[self.pos]
 
-        elif token.tokenType == ttString:
-            if token.tokenText.lower() == 'true':
-                result = 1
-            elif token.tokenText.lower() == 'false':
-                result = 0
+            if token.tokenType not in (ttOperation, ttRelation, ttBoolean) or token.tokenText == '~':
+                break
+
+            priority = PRIORITIES[token.tokenType].get(token.tokenText, 0)
+            if priority <= minPriority:
+                break
+
+            self.pos += 1
+            text = intern(token.tokenText)
+
+            if text in POSTFIX_OPERATIONS:
+                left = ExpNode(OPCODES[text], text, None, (left,))
             else:
-                result = self.evaluate()
-
-        elif token.tokenType == ttOperation:
-            if token.tokenText == '+':
-                result = self.childLeft[0].asFloat() + self.childRight[0].asFloat()
-            elif token.tokenText == '-':
-                if len(self.childLeft) == 0 and len(self.childRight) == 1:
-                    result = self.childRight[0].calculate()*(-1)
-                else:
-                    result = self.childLeft[0].asFloat() - self.childRight[0].asFloat()
-            elif token.tokenText == '*':
-                result = self.childLeft[0].asFloat() * self.childRight[0].asFloat()
-            elif token.tokenText == '/':
-                result = self.childLeft[0].asFloat() / self.childRight[0].asFloat()
-            elif token.tokenText == '^':
-                result = self.childLeft[0].asFloat()**self.childRight[0].asFloat()
-            elif token.tokenText == '%':  # module
-                result = int(self.childLeft[0].asFloat()) % int(self.childRight[0].asFloat())
-            elif token.tokenText == '!':
-                result = int(math.factorial(self.childLeft[0].asFloat()))
-            elif token.tokenText == '~':
-                if int(self.childRight[0].asFloat()) == 1:
-                    result = 0
-                else:
-                    result = 1
-
-        elif token.tokenType == ttBoolean:
-            left  = self.childLeft[0].asFloat()
-            rigth = self.childRight[0].asFloat()
-
-            if token.tokenText == '&' and left == 1 and rigth == 1:
-                result = 1
-            elif token.tokenText == '|' and (left == 1 or rigth == 1):
-                result = 1
-            elif token.tokenText == '?' and ( (left == 1 and rigth == 0) or (left == 0 and rigth == 1) ):
-                result = 1
-
-        elif token.tokenType == ttRelation:
-            left  = self.childLeft[0].calculate()
-            rigth = self.childRight[0].calculate()
-
-            if token.tokenText == '>' and left > rigth:
-                result = 1
-            elif token.tokenText == '<' and left < rigth:
-                result = 1
-            elif token.tokenText == '<=' and left >= rigth:
-                result = 1
-            elif token.tokenText == '>=' and lefft >= rigth:
-                result = 1
-            elif token.tokenText == '<>' and left != rigth:
-                result = 1
-            elif token.tokenText == '=' and left == rigth:
-                result = 1
+                left = ExpNode(OPCODES[text], text, None, (left,), (self.parseExpression(priority),))
+
+        return left
+
+    def parsePrefix(self):
+        token = self.next()
+        tokenType = token.tokenType
+
+        if tokenType == ttOperation and token.tokenText in PREFIX_OPERATIONS:
+            priority = PRIORITIES[ttOperation][token.tokenText]
+            text = intern(token.tokenText)
+            opcode = opNegate if text == '-' else OPCODES[text]
+            return ExpNode(opcode, text, None, (), (self.parseExpression(priority),))
+
+        elif tokenType == ttParenthesisOpen:
+            node = self.parseExpression(-1)
+            if self.next().tokenType != ttParenthesisClose:
+                self.error()
+            return node
+
+        elif tokenType == ttString and self.peekType() == ttParenthesisOpen:
+            self.pos += 1
+            args = []
+            if self.peekType() == ttParenthesisClose:
+                self.pos += 1
+                return self.leaf(token, args)
+            while True:
+                args.append(self.parseExpression(-1))
+                delimitor = self.next()
+                if delimitor.tokenType == ttParenthesisClose:
+                    return self.leaf(token, args)
+                elif delimitor.tokenType != ttParamDelimitor:
+                    raise Exception(ERROR_FUNCTION_PARSE % token.tokenText)
+                elif self.peekType() == ttParenthesisClose:
+                    self.pos += 1
+                    return self.leaf(token, args)
+
+        elif tokenType in (ttString, ttNumeric, ttOldValue):
+            return self.leaf(token)
+
+        self.error()
+
+
+def calculateLazy(name, nodes, owner):
+    """Calculates the builtins if, and, or with only the arguments they need"""
+
+    if name == 'if':
+        if len(nodes) != 3:
+            raise Exception(ERROR_FUNCTION_PARAMETER % name)
+        return nodes[1 if bool(nodes[0].calculate(owner)) else 2].calculate(owner)
+
+    stop = name == 'or'
+    for node in nodes:
+        if bool(node.calculate(owner)) == stop:
+            return 1 if stop else 0
+    return 0 if stop else 1
+
+def tokenize(expression):
+    """Generator of the tokens of the expression (see ExpParser.iterTokens)"""
+    return ExpParser(expression).iterTokens()
+
+
+def buildTree(expression):
+    """Breaks the expression into tokens and builds its syntax tree"""
+    return ExpBuilder(expression, list(tokenize(expression))).build()
+
+
+class ExpCache(object):
+    """Process-wide LRU cache of syntax trees keyed by expression text.
+
+    The trees are never changed after build, so one tree is shared by every
+    FatExpression compiling the same text. A capacity of 0 disables the cache.
+    """
+    def __init__(self, capacity=1024):
+        self._trees = OrderedDict()
+        self._lock = threading.Lock()
+        self._capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._trees)
+
+    def __contains__(self, expression):
+        return expression in self._trees
 
-        return result
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @capacity.setter
+    def capacity(self, value):
+        with self._lock:
+            self._capacity = max(0, int(value))
+            self._evict()
+
+    def _evict(self):
+        while len(self._trees) > self._capacity:
+            self._trees.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, expression):
+        with self._lock:
+            tree = self._trees.get(expression)
+            if tree is not None:
+                self._trees.move_to_end(expression)
+                self.hits += 1
+                return tree
+            self.misses += 1
+
+        tree = buildTree(expression)
+
+        with self._lock:
+            self._trees[expression] = tree
+            self._evict()
+
+        return tree
+
+    def clear(self):
+        with self._lock:
+            self._trees.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return {'size': len(self._trees), 'capacity': self._capacity,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+expCache = ExpCache()
+
+
+# result of ExpMemo.find for keys not cached
+MISSING = object()
+
+
+class ExpMemo(object):
+    """LRU cache of the results of an evaluate callback keyed by name and arguments.
+
+    Calling it calls evaluate only for a key not cached or older than ttl
+    seconds (None keeps results until evicted); None results are cached too.
+    Awaitable results are cached once awaited. A capacity of 0 disables the
+    cache. Use invalidate() when the data read by the callback changes.
+    Pure user-defined functions keep their results by arguments in an ExpMemo
+    without evaluate (see find and put).
+    """
+    def __init__(self, evaluate, capacity=1024, ttl=None, clock=time.monotonic):
+        self.evaluate = evaluate
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self._capacity = max(0, int(capacity))
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    def __getstate__(self):
+        return (self.evaluate, self._capacity, self.ttl, self.clock)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @capacity.setter
+    def capacity(self, value):
+        with self._lock:
+            self._capacity = max(0, int(value))
+            self._evict()
+
+    def _evict(self):
+        while len(self._results) > self._capacity:
+            self._results.popitem(last=False)
+            self.evictions += 1
+
+    def __call__(self, text, args):
+        key = (text, tuple(args))
+        value = self.find(key)
+        if value is not MISSING:
+            return value
 
-    def asFloat(self):
-        return float(self.calculate())
+        value = self.evaluate(text, args)
+        if inspect.isawaitable(value):
+            return self._store(key, value)
+        self.put(key, value)
+        return value
+
+    async def _store(self, key, value):
+        value = await value
+        self.put(key, value)
+        return value
+
+    def find(self, key):
+        """The result cached for key, or MISSING"""
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > self.clock()):
+                self._results.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        return MISSING
+
+    def put(self, key, value):
+        with self._lock:
+            self._results[key] = (value, None if self.ttl is None else self.clock() + self.ttl)
+            self._results.move_to_end(key)
+            self._evict()
+
+    def invalidate(self, text=None, args=None):
+        """Removes the results of name text (all names when None) and, when given, args"""
+        with self._lock:
+            if text is None:
+                self._results.clear()
+            elif args is not None:
+                self._results.pop((text.strip().lower(), tuple(args)), None)
+            else:
+                for key in [key for key in self._results if key[0] == text.strip().lower()]:
+                    del self._results[key]
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return {'size': len(self._results), 'capacity': self._capacity,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class ExpNative(object):
+    """Python function called by name from expressions.
+
+    argCount is the number of arguments, a tuple of the accepted numbers or
+    None for any number. Pure functions return the same value for the same
+    arguments, so calls with constant arguments may be folded and repeated
+    calls shared. vector is the same function over NumPy arrays, or None.
+    """
+    __slots__ = ('name', 'function', 'argCount', 'pure', 'vector')
+
+    def __init__(self, name, function, argCount=None, pure=True, vector=None):
+        self.name = name.strip().lower()
+        self.function = function
+        if isinstance(argCount, int):
+            argCount = (argCount,)
+        self.argCount = None if argCount is None else tuple(argCount)
+        self.pure = pure
+        self.vector = vector
+
+    def __repr__(self):
+        return '<ExpNative: %s>' % self.name
+
+    def accepts(self, argCount):
+        return self.argCount is None or argCount in self.argCount
+
+    def call(self, args):
+        if not self.accepts(len(args)):
+            raise Exception(ERROR_FUNCTION_PARAMETER % self.name)
+        return self.function(*args)
+
+
+# native functions of new FatExpression objects (see FatExpression.addNative)
+nativeFunctions = {}
+
+def registerNative(name, function, argCount=None, pure=True, vector=None):
+    """Adds a native function to the ones of the FatExpression objects created afterwards"""
+    native = ExpNative(name, function, argCount, pure, vector)
+    nativeFunctions[native.name] = native
+    return native
+
+def _sign(x):
+    if x == abs(x):
+        return 1
+    elif x == 0:
+        return 0
+    else:
+        return -1
+
+def _and(*args):
+    for arg in args:
+        if not bool(arg):
+            return 0
+    return 1
+
+def _or(*args):
+    for arg in args:
+        if bool(arg):
+            return 1
+    return 0
+
+registerNative('abs', abs, 1, vector=lambda a: numpy.abs(a))
+registerNative('frac', lambda x: x - int(x), 1, vector=lambda a: a - numpy.trunc(a))
+registerNative('max', lambda *args: max(args), vector=lambda *args: reduce(numpy.maximum, args))
+registerNative('min', lambda *args: min(args), vector=lambda *args: reduce(numpy.minimum, args))
+registerNative('mod', lambda x, y: math.fmod(int(x), int(y)), 2,
+               vector=lambda a, b: numpy.fmod(numpy.trunc(a), numpy.trunc(b)))
+registerNative('round', lambda x, digits=2: round(x, int(digits)), (1, 2))
+registerNative('sign', _sign, 1, vector=lambda a: numpy.where(a == numpy.abs(a), 1.0, -1.0))
+registerNative('sqrt', math.sqrt, 1, vector=lambda a: numpy.sqrt(a))
+registerNative('sin', math.sin, 1, vector=lambda a: numpy.sin(a))
+registerNative('cos', math.cos, 1, vector=lambda a: numpy.cos(a))
+registerNative('tan', math.tan, 1, vector=lambda a: numpy.tan(a))
+registerNative('atan', math.atan, 1, vector=lambda a: numpy.arctan(a))
+registerNative('log', math.log, 1, vector=lambda a: numpy.log(a))
+registerNative('exp', math.exp, 1, vector=lambda a: numpy.exp(a))
+registerNative('sum', lambda *args: sum(args), vector=lambda *args: reduce(numpy.add, args))
+registerNative('trunc', math.trunc, 1, vector=lambda a: numpy.trunc(a))
+registerNative('and', _and, vector=lambda *args: reduce(numpy.logical_and, [a != 0 for a in args], True))
+registerNative('or', _or, vector=lambda *args: reduce(numpy.logical_or, [a != 0 for a in args], False))
+registerNative('if', lambda condition, first, second: first if bool(condition) else second, 3,
+               vector=lambda c, a, b: numpy.where(c != 0, a, b))
+registerNative('random', random.random, 0, pure=False)
+
+
+class ExpFrame(object):
+    """Argument values of one call of an user-defined function"""
+    __slots__ = ('function', 'values', 'owner')
+
+    def __init__(self, function, values, owner=None):
+        self.function = function
+        self.values = values
+        if owner is None:
+            owner = function.owner
+        elif isinstance(owner, ExpFrame):
+            owner = owner.owner
+        self.owner = owner  # FatExpression or ExpContext running the call
+
+    @property
+    def _value_old(self):
+        return self.owner._value_old
+
+    @property
+    def variables(self):
+        return self.owner.variables
+
+    def _callEvaluates(self, text, args):
+        return self.owner._callEvaluates(text, args)
+
+    def evaluate(self, text, args):
+        index = self.function.argIndex.get(text.strip().lower())
+        if index is not None:
+            return self.values[index]
+        if isinstance(self.owner, (FatExpression, ExpContext)):
+            return self.owner.evaluate(text, args)
+        else:
+            return 0
+
+    def evaluateLazy(self, text, nodes):
+        if text in self.function.argIndex or not isinstance(self.owner, (FatExpression, ExpContext)):
+            return None
+        return self.owner.evaluateLazy(text, nodes, self)
 
 
 class ExpFunction:
@@ -620,7 +979,10 @@ class ExpFunction:
         self.name = ''
         self.function = ''
         self.args = []
-        self.values = []
+        self.argIndex = {}
+        self.tree = None
+        self.body = None  # tree with resolved identifiers (see ExpResolver), run by call
+        self.memo = None  # ExpMemo of the results of a pure function (see addFunctions)
 
     def __repr__(self):
         return '<ExpFunction: %s>' % self.name
@@ -629,32 +991,31 @@ class ExpFunction:
     def argCount(self):
          return len(self.args)
 
-    def call(self, values):
+    def call(self, values, owner=None):
+        """Calculates the body; names other than the arguments are evaluated by owner
+        (default the owner of the function)"""
 
         if len(self.args) != len(values):
             raise Exception(ERROR_FUNCTION_PARAMETER % self.name)
 
-        self.values = values[:]
-
-        parser = ExpParser(self.function)
-
-        token = parser.readFirstToken()
-        while token:
-            token = parser.readNextToken()
-
-        tree = ExpNode(self, None, parser.tokens)
-        tree.build()
-
-        return tree.calculate()
-
-    def evalArgs(self, text, args):
-        for index, value in enumerate(self.args):
-            if value.lower() == text.lower():
-                return self.values[index]
-        if isinstance(self.owner, FatExpression):
-            return self.owner.evaluate(text, args)
-        else:
-            return 0
+        memo = self.memo
+        if memo is None:
+            return self.body.calculate(ExpFrame(self, values, owner))
+
+        key = tuple(values)
+        value = memo.find(key)
+        if value is MISSING:
+            value = self.body.calculate(ExpFrame(self, values, owner))
+            memo.put(key, value)
+        return value
+
+    def references(self):
+        """Names called by the body, except the arguments"""
+        result = set()
+        for node in self.tree.walk():
+            if node.opcode == opIdentifier and node.value not in self.argIndex:
+                result.add(node.value)
+        return result
 
     def _setHeader(self, value):
         self.args = []
@@ -710,6 +1071,10 @@ class ExpFunction:
         if ExpectParenthesisClose:
             raise Exception(ERROR_FUNCTION_CLOSE % self.name)
 
+        self.argIndex = {}
+        for index, arg in enumerate(self.args):
+            self.argIndex.setdefault(arg.lower(), index)
+
     def _setAsString(self, value):
 
         if value.find('=') == -1:
@@ -719,32 +1084,2162 @@ class ExpFunction:
         head, self.function = value.split('=', 1)
 
         self._setHeader(head)
+        self.tree = expCache.get(self.function.strip())
+        self.body = self.tree
+
+class ExpResolver(object):
+    """Resolves the identifiers of the syntax trees of a FatExpression once, when compiling.
+
+    The copies run by the tree walker read the arguments of user-defined
+    functions by index and the variables assigned in a previous line, the
+    input variables and the user-defined and native functions they call
+    directly. Other names call the evaluate callbacks. Resolution follows
+    FatExpression.evaluate; a variable added after compiling still hides a
+    function. With eoEventFirst only the arguments are resolved, and in
+    function bodies the names assigned by the text are resolved when called.
+    """
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.eventFirst = owner.evaluateOrder == eoEventFirst
+        self.builtins = owner._evaluates[:1] == [owner.evaluateCustom]
+
+    def resolve(self, lines):
+        """Returns the resolved lines; also resolves the bodies of the user-defined functions"""
+        self.programAssigned = set(variable for variable, tree in lines if variable)
+
+        for function in self.owner.functions.values():
+            function.body = self.node(function.tree, function, None)
+
+        for function in self.owner.functions.values():
+            if function.memo is not None:
+                reason = self.impurity(function)
+                if reason is not None:
+                    raise Exception(ERROR_FUNCTION_IMPURE % (function.name, reason))
+                # the results depend on the functions and natives when compiling
+                function.memo.invalidate()
+
+        result = []
+        assigned = set()
+        for variable, tree in lines:
+            result.append((variable, self.node(tree, None, assigned)))
+            if variable:
+                assigned.add(variable)
+        return result
+
+    def node(self, node, function, assigned):
+        """Resolved copy of node; assigned is None inside user-defined functions"""
+        childLeft = tuple(self.node(child, function, assigned) for child in node.childLeft)
+        childRight = tuple(self.node(child, function, assigned) for child in node.childRight)
+
+        opcode, value = node.opcode, node.value
+        if opcode == opIdentifier:
+            opcode, value = self.identifier(value, function, assigned)
+
+        if opcode == node.opcode and childLeft == node.childLeft and childRight == node.childRight:
+            return node
+        return ExpNode(opcode, node.text, value, childLeft, childRight)
+
+    def identifier(self, name, function, assigned):
+        """(opcode, value) of the node of name"""
+        owner = self.owner
+
+        if function is not None and name in function.argIndex:
+            return opArgument, function.argIndex[name]
+        if self.eventFirst:
+            return opIdentifier, name
+
+        if assigned is None:
+            if name in self.programAssigned:
+                # the assignments seen by a function depend on the line calling it
+                return opIdentifier, name
+        elif name in assigned:
+            return opLocal, name
+
+        if owner.variables.get(name) is not None:
+            return opVariable, name
+
+        udf = owner.findFunction(name)
+        if udf is not None:
+            return opCallFunction, (name, udf)
+
+        native = owner.natives.get(name) if self.builtins else None
+        if native is not None:
+            return opCallNative, (name, native)
+
+        return opCall, (name, None)
+
+    def impurity(self, function):
+        """Text of the first name making the resolved body of function depend on more
+        than its arguments (input variables, assignments, _, callbacks, impure natives),
+        or None; pure callbacks are excluded too, as they are pure within one evaluation
+        and the results are kept across evaluations"""
+        for node in function.body.walk():
+            opcode = node.opcode
+            if opcode in (opOldValue, opVariable, opIdentifier, opLocal, opCall):
+                return node.text
+            elif opcode == opCallNative and not node.value[1].pure:
+                return node.text
+            elif opcode == opCallFunction and self.impurity(node.value[1]) is not None:
+                return node.text
+
+
+def isPureCallback(owner, name):
+    """Whether the callbacks of owner return one value for name and the same arguments"""
+    for evaluate in owner._evaluates:
+        if evaluate == owner.evaluateCustom:
+            if name in owner.natives:
+                return owner.natives[name].pure
+        elif evaluate not in owner._pureEvaluates:
+            return False
+    return True
+
+
+class ExpOptimizer(object):
+    """Simplifies the syntax trees of a FatExpression; the trees are copied, never changed.
+
+    Constant subtrees, including calls of the pure native functions, are
+    replaced by their value. Identities (x*1, x/1, x^1, x+0, x-0, --x, ~~x)
+    are removed when x already has the type the operation returns, so results
+    are the same as before. if() with a constant condition is replaced by the
+    chosen argument. Builtins are folded only with eoInternalFirst, while
+    evaluateCustom answers first and the name is not a variable, an earlier
+    assignment or a user-defined function. eliminated counts removed nodes.
+
+    share() computes repeated subtrees without side effects once per
+    evaluation: the first occurrence becomes an opStore node keeping the value
+    in the locals and the others opLocal nodes reading it. random and the
+    callbacks not added as pure are never shared, and a value is never kept
+    inside an argument that if, and, or, & or | may skip. shared counts the
+    occurrences replaced by a read.
+
+    inline() replaces the calls of small user-defined functions by their
+    bodies, before the other passes. An argument is put in place of its
+    uses; one that is not a constant or a name is kept in an opStore node
+    where first used when used more than once. Calls are kept with
+    eoEventFirst, for functions keeping their results (see addFunctions),
+    with arguments that are not pure or that the body may skip, and when
+    the arguments must be kept in a call that if, and, or, & or | may skip.
+    inlined counts the calls replaced.
+    """
+
+    FLOATS = (opNumeric, opAdd, opSubtract, opMultiply, opDivide, opPower)
+    BOOLEANS = (opTrue, opFalse, opNot, opAnd, opOr, opXor, opGreater, opLess,
+                opGreaterEqual, opLessEqual, opDifferent, opEqual)
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.builtins = (owner.evaluateOrder == eoInternalFirst
+                         and owner._evaluates[:1] == [owner.evaluateCustom])
+        self.eliminated = 0
+        self.shared = 0
+        self.inlined = 0
+        self._pureFunctions = {}
+        self._temporaries = 0
+
+    def optimize(self, lines):
+        """Returns the optimized (variable, tree) lines"""
+        result = []
+        assigned = set()
+        for variable, tree in lines:
+            optimized = self.node(tree, assigned)
+            self.eliminated += self._size(tree) - self._size(optimized)
+            result.append((variable, optimized))
+            if variable:
+                assigned.add(variable)
+        return result
+
+    def _size(self, node):
+        return sum(1 for n in node.walk())
+
+    def inline(self, lines, limit):
+        """Returns the lines with the calls of the functions of at most limit nodes inlined"""
+        self._assigned = set(variable for variable, tree in lines if variable)
+        result = []
+        assigned = set()
+        for variable, tree in lines:
+            result.append((variable, self._inline(tree, assigned, limit, False)))
+            if variable:
+                assigned.add(variable)
+        return result
+
+    def _inline(self, node, assigned, limit, conditional):
+        first = 0 if node.opcode in (opAnd, opOr) else 1 if node.value in LAZY_FUNCTIONS else None
+        childLeft = tuple(self._inline(child, assigned, limit, conditional) for child in node.childLeft)
+        childRight = tuple(self._inline(child, assigned, limit,
+                                        conditional or (first is not None and index >= first))
+                           for index, child in enumerate(node.childRight))
+        if childLeft != node.childLeft or childRight != node.childRight:
+            node = ExpNode(node.opcode, node.text, node.value, childLeft, childRight)
+
+        if node.opcode == opIdentifier:
+            body = self.expand(node, assigned, limit, conditional)
+            if body is not None:
+                self.inlined += 1
+                # the body may call other functions
+                return self._inline(body, assigned, limit, conditional)
+        return node
+
+    def expand(self, node, assigned, limit, conditional):
+        """Body of the function called by node with the arguments in place, or None"""
+        owner = self.owner
+        name = node.value
+        if owner.evaluateOrder != eoInternalFirst or name in assigned \
+                or owner.expParser.findVariable(name) is not None:
+            return None
+        function = owner.findFunction(name)
+        if function is None or function.memo is not None or len(function.args) != len(node.childRight) \
+                or self._size(function.tree) > limit:
+            return None
+
+        uses = dict((index, []) for index in range(len(function.args)))
+        self._uses(function.tree, function, uses, False)
+
+        values = []
+        for index, arg in enumerate(node.childRight):
+            arg = self.node(arg, assigned)
+            if not all(child.opcode != opIdentifier or self.isPure(child.value, assigned) for child in arg.walk()):
+                return None
+            if arg.opcode in (opNumeric, opTrue, opFalse, opOldValue, opLocal):
+                values.append((arg, None))
+            elif not uses[index] or uses[index][0]:
+                # the call would calculate the argument even when the body does not
+                return None
+            elif len(uses[index]) == 1 or arg.opcode == opIdentifier and not arg.childRight:
+                values.append((arg, None))
+            elif not conditional:
+                values.append((arg, intern('_inl%d' % self._temporaries)))
+                self._temporaries += 1
+            else:
+                return None
+
+        return self._substitute(function.tree, function, values, set())
+
+    def _uses(self, node, function, uses, conditional):
+        """Appends to uses[index] whether each use of an argument, in evaluation order, may be skipped"""
+        if node.opcode == opIdentifier and node.value in function.argIndex:
+            uses[function.argIndex[node.value]].append(conditional)
+            return
+        first = 0 if node.opcode in (opAnd, opOr) else 1 if node.value in LAZY_FUNCTIONS else None
+        for child in node.childLeft:
+            self._uses(child, function, uses, conditional)
+        for index, child in enumerate(node.childRight):
+            self._uses(child, function, uses, conditional or (first is not None and index >= first))
+
+    def _substitute(self, node, function, values, stored):
+        if node.opcode == opIdentifier and node.value in function.argIndex:
+            index = function.argIndex[node.value]
+            arg, name = values[index]
+            if name is None:
+                return arg
+            elif index in stored:
+                return ExpNode(opLocal, name, name)
+            stored.add(index)
+            return ExpNode(opStore, name, name, (), (arg,))
+
+        childLeft = tuple(self._substitute(child, function, values, stored) for child in node.childLeft)
+        childRight = tuple(self._substitute(child, function, values, stored) for child in node.childRight)
+        if childLeft == node.childLeft and childRight == node.childRight:
+            return node
+        return ExpNode(node.opcode, node.text, node.value, childLeft, childRight)
+
+    def evaluate(self, name, args):
+        return self.owner.evaluateCustom(name, args)
+
+    def evaluateLazy(self, name, nodes):
+        return None
+
+    def isFloat(self, node):
+        if node.opcode == opNegate:
+            return self.isFloat(node.childRight[0])
+        return node.opcode in self.FLOATS
+
+    def isBoolean(self, node):
+        return node.opcode in self.BOOLEANS
+
+    def isBuiltin(self, node, assigned):
+        name = node.value
+        native = self.owner.natives.get(name)
+        return (self.builtins and native is not None and native.pure and name not in assigned
+                and self.owner.expParser.findVariable(name) is None
+                and self.owner.findFunction(name) is None)
+
+    def isConstant(self, node):
+        return node.opcode in (opNumeric, opTrue, opFalse)
+
+    def literal(self, node):
+        """Node holding the value of a constant subtree, or None when it can not be folded"""
+        try:
+            value = node.calculate(self)
+        except Exception:
+            # errors such as a division by zero are raised when evaluating
+            return None
+        if isinstance(value, float):
+            if math.isinf(value) or math.isnan(value):
+                return None
+            return ExpNode(opNumeric, repr(value), value)
+        elif type(value) is int and value in (0, 1):
+            return ExpNode(opTrue, 'true') if value else ExpNode(opFalse, 'false')
+        return None
+
+    def node(self, node, assigned):
+        """Optimized copy of node (or node itself when nothing changes)"""
+
+        opcode = node.opcode
+
+        if not node.childLeft and not node.childRight:
+            if opcode == opIdentifier and self.isBuiltin(node, assigned):
+                return self.literal(node) or node
+            return node
+
+        childLeft = tuple(self.node(child, assigned) for child in node.childLeft)
+        childRight = tuple(self.node(child, assigned) for child in node.childRight)
+
+        if opcode == opIdentifier:
+            if self.isBuiltin(node, assigned):
+                if all(self.isConstant(child) for child in childRight):
+                    folded = self.literal(ExpNode(opcode, node.text, node.value, (), childRight))
+                    if folded is not None:
+                        return folded
+                elif node.value == 'if' and len(childRight) == 3 and self.isConstant(childRight[0]):
+                    return childRight[1] if childRight[0].calculate(self) else childRight[2]
+
+        elif all(self.isConstant(child) for child in childLeft + childRight):
+            folded = self.literal(ExpNode(opcode, node.text, node.value, childLeft, childRight))
+            if folded is not None:
+                return folded
+
+        else:
+            simplified = self.identity(opcode, childLeft, childRight)
+            if simplified is not None:
+                return simplified
+
+        if childLeft == node.childLeft and childRight == node.childRight:
+            return node
+        return ExpNode(opcode, node.text, node.value, childLeft, childRight)
+
+    def identity(self, opcode, childLeft, childRight):
+        """Operand that gives the result of an identity operation, or None"""
+
+        def number(nodes, value):
+            return nodes[0].opcode == opNumeric and nodes[0].value == value
+
+        if opcode == opNegate:
+            child = childRight[0]
+            if child.opcode == opNegate:
+                return child.childRight[0]
+
+        elif opcode == opNot:
+            child = childRight[0]
+            if child.opcode == opNot and self.isBoolean(child.childRight[0]):
+                return child.childRight[0]
+
+        elif opcode in (opAdd, opSubtract, opMultiply, opDivide, opPower):
+            neutral = 0.0 if opcode in (opAdd, opSubtract) else 1.0
+            if number(childRight, neutral) and self.isFloat(childLeft[0]):
+                return childLeft[0]
+            if opcode in (opAdd, opMultiply) and number(childLeft, neutral) and self.isFloat(childRight[0]):
+                return childRight[0]
+
+        return None
+
+    def share(self, lines):
+        """Returns the lines with the repeated pure subtrees shared"""
+
+        # key of every node: equal keys give equal values during one evaluation
+        keys = []
+        pure = {}
+        interior = set()
+        versions = {}
+        self._assigned = set(variable for variable, tree in lines if variable)
+        for index, (variable, tree) in enumerate(lines):
+            lineKeys = {}
+            self._keys(tree, index, versions, lineKeys, pure, interior)
+            keys.append(lineKeys)
+            if variable:
+                versions[variable] = index
+
+        # references of every distinct subtree, counting the children of a repeated subtree once
+        refs = {}
+        for (variable, tree), lineKeys in zip(lines, keys):
+            stack = [tree]
+            while stack:
+                node = stack.pop()
+                key = lineKeys[id(node)]
+                refs[key] = refs.get(key, 0) + 1
+                if refs[key] == 1:
+                    stack.extend(node.childLeft + node.childRight)
+
+        names = {}
+        for key, count in refs.items():
+            if count > 1 and pure[key] and key in interior:
+                names[key] = intern('_cse%d' % len(names))
+
+        if not names:
+            return lines
+
+        defined = set()
+        return [(variable, self._rewrite(tree, lineKeys, names, defined))
+                for (variable, tree), lineKeys in zip(lines, keys)]
+
+    def _keys(self, node, index, versions, lineKeys, pure, interior):
+        """Key of node; interior collects the keys of nodes with children, the ones worth sharing"""
+        opcode = node.opcode
+        childLeft = tuple(self._keys(child, index, versions, lineKeys, pure, interior)
+                          for child in node.childLeft)
+        childRight = tuple(self._keys(child, index, versions, lineKeys, pure, interior)
+                           for child in node.childRight)
+        isPure = all(pure[key] for key in childLeft + childRight)
+
+        if opcode == opIdentifier:
+            key = (opcode, node.value, versions.get(node.value, -1), childRight)
+            isPure = isPure and self.isPure(node.value, versions)
+        elif opcode == opNumeric:
+            key = (opcode, node.value)
+        elif opcode == opOldValue:
+            key = (opcode, index)
+        elif opcode == opLocal or opcode == opStore:
+            key = (opcode, node.value, childRight)
+        elif childLeft or childRight:
+            key = (opcode, childLeft, childRight)
+        else:
+            key = (opcode,)
+
+        lineKeys[id(node)] = key
+        pure[key] = isPure
+        if childLeft or childRight:
+            interior.add(key)
+        return key
+
+    def isPure(self, name, assigned):
+        """Whether name has one value during an evaluation, wherever it is used"""
+        owner = self.owner
+        internal = name in assigned or owner.expParser.findVariable(name) is not None
+        udf = None if internal else owner.findFunction(name)
+
+        if owner.evaluateOrder == eoEventFirst:
+            return self.isPureCallback(name) and (udf is None or self.isPureFunction(udf))
+        elif internal:
+            return True
+        elif udf is not None:
+            return self.isPureFunction(udf)
+        return self.isPureCallback(name)
+
+    def isPureCallback(self, name):
+        return isPureCallback(self.owner, name)
+
+    def isPureFunction(self, function):
+        """Whether a user-defined function depends only on its arguments and pure names"""
+        result = self._pureFunctions.get(function.name.lower())
+        if result is None:
+            result = True
+            for node in function.tree.walk():
+                if node.opcode == opOldValue:
+                    result = False
+                elif node.opcode == opIdentifier and node.value not in function.argIndex:
+                    # the locals seen by a function depend on the line calling it
+                    if node.value in self._assigned or not self.isPure(node.value, ()):
+                        result = False
+                if not result:
+                    break
+            self._pureFunctions[function.name.lower()] = result
+        return result
+
+    def _rewrite(self, node, lineKeys, names, defined, conditional=False):
+        """Copy of node in evaluation order, storing each shared subtree where it is first computed;
+        conditional nodes may be skipped, so they only read values stored before"""
+        key = lineKeys[id(node)]
+        name = names.get(key)
+        if name is not None and key in defined:
+            self.shared += 1
+            return ExpNode(opLocal, name, name)
+
+        # the right side of & and | and the arguments after the first of if, and, or
+        first = 0 if node.opcode in (opAnd, opOr) else 1 if node.value in LAZY_FUNCTIONS else None
+        childLeft = tuple(self._rewrite(child, lineKeys, names, defined, conditional)
+                          for child in node.childLeft)
+        childRight = tuple(self._rewrite(child, lineKeys, names, defined,
+                                         conditional or (first is not None and index >= first))
+                           for index, child in enumerate(node.childRight))
+        if childLeft != node.childLeft or childRight != node.childRight:
+            node = ExpNode(node.opcode, node.text, node.value, childLeft, childRight)
+
+        if name is not None and not conditional:
+            defined.add(key)
+            return ExpNode(opStore, name, name, (), (node,))
+        return node
+
+
+class ExpVector(object):
+    """Evaluates syntax trees over NumPy column arrays instead of scalars.
+
+    Operations map to ufuncs, relations and logic to 0/1 arrays and if() to
+    numpy.where. Identifiers resolve like FatExpression.evaluate: assigned
+    variables, columns and variables, user-defined functions (their bodies are
+    vectorized too), the vector variants of the native functions and, last,
+    the evaluate callbacks, which are called once per row. Division by zero
+    gives inf/nan instead of raising.
+    """
+
+    OPERATIONS = {
+        opAdd: lambda a, b: a + b,
+        opSubtract: lambda a, b: a - b,
+        opMultiply: lambda a, b: a * b,
+        opDivide: lambda a, b: numpy.true_divide(a, b),
+        opPower: lambda a, b: numpy.power(a, b),
+        opModule: lambda a, b: numpy.mod(numpy.trunc(a), numpy.trunc(b)),
+        opAnd: lambda a, b: (a == 1) & (b == 1),
+        opOr: lambda a, b: (a == 1) | (b == 1),
+        opXor: lambda a, b: ((a == 1) & (b == 0)) | ((a == 0) & (b == 1)),
+        opGreater: lambda a, b: a > b,
+        opLess: lambda a, b: a < b,
+        opLessEqual: lambda a, b: a <= b,
+        opGreaterEqual: lambda a, b: a >= b,
+        opDifferent: lambda a, b: a != b,
+        opEqual: lambda a, b: a == b,
+    }
+
+    def __init__(self, owner, columns):
+        if numpy is None:
+            raise Exception(ERROR_NUMPY)
+
+        self.owner = owner
+        self.columns = {}
+        for name, column in columns.items():
+            self.columns[name.strip().lower()] = numpy.asarray(column, dtype=float)
+
+        sizes = set(len(column) for column in self.columns.values())
+        if len(sizes) > 1:
+            raise Exception(ERROR_BATCH_COLUMNS)
+        self.size = sizes.pop() if sizes else 0
+
+        self.builtins = owner._evaluates[:1] == [owner.evaluateCustom]
+        self.locals = {}
+        self.old = 0.0
+
+    def run(self, program):
+        result = 0.0
+        self.locals = {}
+        self.old = 0.0
+
+        with numpy.errstate(all='ignore'):
+            for variable, tree in program:
+                result = self.calculate(tree, None)
+                self.old = result
+                if variable:
+                    self.locals[variable] = result
+
+        return numpy.array(numpy.broadcast_to(result, (self.size,)), dtype=float)
+
+    def calculate(self, node, frame):
+
+        opcode = node.opcode
+
+        if opcode == opNumeric:
+            return node.value
+
+        elif opcode == opIdentifier:
+            args = [self.calculate(child, frame) for child in node.childRight]
+            return self.evaluate(node.value, args, frame)
+
+        elif opcode == opOldValue:
+            return self.old
+
+        elif opcode == opLocal:
+            return self.locals[node.value]
+
+        elif opcode == opStore:
+            value = self.calculate(node.childRight[0], frame)
+            self.locals[node.value] = value
+            return value
+
+        elif opcode == opTrue:
+            return 1.0
+
+        elif opcode == opFalse or opcode == opNone:
+            return 0.0
+
+        elif opcode == opNegate:
+            return -self.asArray(self.calculate(node.childRight[0], frame))
+
+        elif opcode == opFactorial:
+            value = numpy.broadcast_to(self.calculate(node.childLeft[0], frame), (self.size,))
+            return numpy.array([math.factorial(int(v)) for v in value], dtype=float)
+
+        elif opcode == opNot:
+            return numpy.where(numpy.trunc(self.calculate(node.childRight[0], frame)) == 1, 0.0, 1.0)
+
+        left = self.calculate(node.childLeft[0], frame)
+        right = self.calculate(node.childRight[0], frame)
+        return self.asArray(self.OPERATIONS[opcode](left, right))
+
+    def asArray(self, value):
+        value = numpy.asarray(value)
+        if value.dtype == bool:
+            return value.astype(float)
+        return value
+
+    def evaluate(self, name, args, frame):
+
+        if frame is not None:
+            index = frame[0].argIndex.get(name)
+            if index is not None:
+                return frame[1][index]
+
+        if name in self.locals:
+            return self.locals[name]
+
+        if name in self.columns:
+            return self.columns[name]
+
+        value = self.owner.expParser.findVariable(name)
+        if value is not None:
+            return value
+
+        function = self.owner.findFunction(name)
+        if function:
+            if len(function.args) != len(args):
+                raise Exception(ERROR_FUNCTION_PARAMETER % function.name)
+            return self.calculate(function.tree, (function, args))
+
+        native = self.owner.natives.get(name) if self.builtins else None
+        if native is not None and native.vector is not None:
+            if not native.accepts(len(args)):
+                raise Exception(ERROR_FUNCTION_PARAMETER % name)
+            if len(args) > 0:
+                return self.asArray(native.vector(*args))
+
+        return self.evaluateRows(name, args)
+
+    def evaluateRows(self, name, args):
+        """Falls back to calling the evaluate callbacks once per row"""
+        arrays = [numpy.broadcast_to(arg, (self.size,)) for arg in args]
+        result = numpy.empty(self.size)
+
+        for i in range(self.size):
+            value = self.owner._callEvaluates(name, [float(arg[i]) for arg in arrays])
+            if value is None:
+                raise Exception(ERROR_UNDECLARED % name)
+            result[i] = value
+
+        return result
+
+
+class ExpCodeGen(object):
+    """Generates one Python function from the compiled lines of a FatExpression.
+
+    The function takes the variables as keyword (or positional) arguments in the
+    order of its "variables" attribute and returns the same value as the tree
+    walker. Assigned variables become Python locals, the reachable user-defined
+    functions nested closures and the common builtins inline Python code. A
+    variable that is not passed, or any other name, is resolved at run time
+    like FatExpression.evaluate does. Names called with arguments always call a
+    function, and the functions are the ones registered when generating.
+
+    Names never appear in the generated source: variables, assignments and
+    functions are numbered (_v0, _l0, _u0) and the variables are read from the
+    dict passed to the generated code.
+    """
+
+    OPERATIONS = {opAdd: '+', opSubtract: '-', opMultiply: '*', opDivide: '/', opPower: '**'}
+    RELATIONS = {opGreater: '>', opLess: '<', opLessEqual: '<=', opGreaterEqual: '>=',
+                 opDifferent: '!=', opEqual: '=='}
+
+    def __init__(self, owner, program):
+        self.owner = owner
+        self.program = program
+        self.eventFirst = owner.evaluateOrder == eoEventFirst
+        self.builtins = owner._evaluates[:1] == [owner.evaluateCustom]
+        self.assigned = set(variable for variable, tree in program if variable)
+        self.functions = []
+        self.variables = []
+        self.statements = []
+        self.natives = []
+        self.locals = {}
+
+    def local(self, name):
+        """Python name of an assigned variable or a shared value"""
+        if name not in self.locals:
+            self.locals[name] = '_l%d' % len(self.locals)
+        return self.locals[name]
+
+    def variable(self, name):
+        return '_v%d' % self.variables.index(name)
+
+    def udf(self, function):
+        return '_u%d' % self.functions.index(function)
+
+    def _collect(self, tree, function, assigned):
+        for node in tree.walk():
+            if node.opcode != opIdentifier:
+                continue
+            name = node.value
+            if function is not None and name in function.argIndex:
+                continue
+            if assigned is not None and name in assigned:
+                continue
+            udf = None if self.eventFirst else self.owner.findFunction(name)
+            if udf is not None:
+                if udf not in self.functions:
+                    self.functions.append(udf)
+                    self._collect(udf.tree, udf, None)
+            elif not node.childRight and name not in self.variables:
+                self.variables.append(name)
+
+    def source(self):
+        assigned = set()
+        for variable, tree in self.program:
+            self._collect(tree, None, assigned)
+            if variable:
+                assigned.add(variable)
+
+        lines = ['def _fatexpression(_variables, _old=0.0):']
+
+        for index, name in enumerate(self.variables):
+            lines.append('    _v%d = _variables.get(%r)' % (index, name))
+
+        for variable in sorted(self.assigned):
+            lines.append('    %s = None' % self.local(variable))
+
+        for index, function in enumerate(self.functions):
+            args = ', '.join('_a%d' % i for i in range(len(function.args)))
+            lines.append('    def _u%d(%s):' % (index, args))
+            lines.append('        return %s' % self.expression(function.tree, function, None))
+            if function.memo is not None:
+                lines.append('    _u%d = _memoize(_u%d, _m%d)' % (index, index, index))
+
+        lines.append('    _value = 0.0')
+
+        assigned = set()
+        for variable, tree in self.program:
+            code = self.expression(tree, None, assigned)
+            lines.extend(self.statements)
+            del self.statements[:]
+            lines.append('    _value = %s' % code)
+            lines.append('    _old = _value')
+            if variable:
+                lines.append('    %s = _value' % self.local(variable))
+                assigned.add(variable)
+
+        lines.append('    return _value')
+        return '\n'.join(lines) + '\n'
+
+    def function(self):
+        source = self.source()
+        owner = self.owner
+        eventFirst = self.eventFirst
+
+        def evaluate(name, args, value):
+            if eventFirst:
+                result = owner._callEvaluates(name, args)
+                if result is not None:
+                    return result
+            if value is not None:
+                return value
+            result = owner.expParser.findVariable(name)
+            if result is None:
+                function = owner.findFunction(name)
+                if function:
+                    result = function.call(args)
+                elif not eventFirst:
+                    result = owner._callEvaluates(name, args)
+            if result is None:
+                raise Exception(ERROR_UNDECLARED % name)
+            return result
+
+        def xor(left, right):
+            return 1 if (left == 1 and right == 0) or (left == 0 and right == 1) else 0
+
+        def memoize(function, memo):
+            def call(*args):
+                value = memo.find(args)
+                if value is MISSING:
+                    value = function(*args)
+                    memo.put(args, value)
+                return value
+            return call
+
+        namespace = {
+            '_math': math, '_evaluate': evaluate, '_custom': owner.evaluateCustom,
+            '_xor': xor, '_factorial': math.factorial, '_memoize': memoize,
+            '_float': float, '_int': int,
+        }
+        for index, native in enumerate(self.natives):
+            namespace['_n%d' % index] = native.function
+        for index, function in enumerate(self.functions):
+            if function.memo is not None:
+                namespace['_m%d' % index] = function.memo
+        exec(compile(source, '<fatexpression>', 'exec'), namespace)
+
+        run = namespace['_fatexpression']
+        names = list(self.variables)
+
+        def result(*args, **variables):
+            old = variables.pop('_old', 0.0)
+            variables.update(zip(names, args))
+            return run(variables, old)
+
+        result.run = run
+        result.variables = names
+        result.source = source
+        return result
+
+    def _float(self, node, code):
+        if node.opcode == opNumeric or node.opcode in self.OPERATIONS:
+            return code
+        return '_float(%s)' % code
+
+    def expression(self, node, function, assigned):
+        """Python code of a node; assigned is None inside user-defined functions"""
+
+        opcode = node.opcode
+
+        if opcode == opNumeric:
+            return repr(node.value)
+
+        elif opcode == opIdentifier:
+            return self.identifier(node, function, assigned)
+
+        elif opcode == opOldValue:
+            return '_old'
+
+        elif opcode == opLocal:
+            return self.local(node.value)
+
+        elif opcode == opStore:
+            # shared subtrees are computed by a statement before the line
+            code = self.expression(node.childRight[0], function, assigned)
+            self.statements.append('    %s = %s' % (self.local(node.value), code))
+            return self.local(node.value)
+
+        elif opcode == opTrue:
+            return '1'
+
+        elif opcode == opFalse or opcode == opNone:
+            return '0'
+
+        def child(nodes, asFloat=True):
+            code = self.expression(nodes[0], function, assigned)
+            return self._float(nodes[0], code) if asFloat else code
+
+        if opcode == opNegate:
+            return '(%s*(-1))' % child(node.childRight, False)
+        elif opcode in self.OPERATIONS:
+            return '(%s %s %s)' % (child(node.childLeft), self.OPERATIONS[opcode], child(node.childRight))
+        elif opcode == opModule:
+            return '(_int(%s) %% _int(%s))' % (child(node.childLeft), child(node.childRight))
+        elif opcode == opFactorial:
+            return '_factorial(_int(%s))' % child(node.childLeft)
+        elif opcode == opNot:
+            return '(0 if _int(%s) == 1 else 1)' % child(node.childRight)
+        elif opcode == opAnd:
+            return '(1 if %s == 1 and %s == 1 else 0)' % (child(node.childLeft), child(node.childRight))
+        elif opcode == opOr:
+            return '(1 if %s == 1 or %s == 1 else 0)' % (child(node.childLeft), child(node.childRight))
+        elif opcode == opXor:
+            return '_xor(%s, %s)' % (child(node.childLeft), child(node.childRight))
+
+        left, right = child(node.childLeft, False), child(node.childRight, False)
+        return '(1 if %s %s %s else 0)' % (left, self.RELATIONS[opcode], right)
+
+    def identifier(self, node, function, assigned):
+        name = node.value
+        args = [self.expression(child, function, assigned) for child in node.childRight]
+        argList = '[%s]' % ', '.join(args)
+
+        if function is not None and name in function.argIndex:
+            return '_a%d' % function.argIndex[name]
+
+        local = name in self.assigned and (assigned is None or name in assigned)
+
+        if self.eventFirst:
+            if self.builtins and self.lazy(name, args):
+                return self.lazy(name, args)
+            value = self.local(name) if local else (self.variable(name) if name in self.variables else 'None')
+            return '_evaluate(%r, %s, %s)' % (name, argList, value)
+
+        if local and assigned is not None:
+            return self.local(name)
+
+        udf = self.owner.findFunction(name)
+
+        if udf is not None and len(udf.args) == len(args):
+            code = '%s(%s)' % (self.udf(udf), ', '.join(args))
+        elif udf is None and self.builtins and self.lazy(name, args):
+            code = self.lazy(name, args)
+        elif udf is None and self.builtins and name in self.owner.natives:
+            native = self.owner.natives[name]
+            if native.accepts(len(args)):
+                code = '%s(%s)' % (self.native(native), ', '.join(args))
+            else:
+                code = '_custom(%r, %s)' % (name, argList)
+        else:
+            code = '_evaluate(%r, %s, None)' % (name, argList)
+
+        if name in self.variables:
+            # a variable hides a native, like in ExpNode.call
+            code = '(%s if %s is not None else %s)' % (self.variable(name), self.variable(name), code)
+
+        if local:
+            return '(%s if %s is not None else %s)' % (self.local(name), self.local(name), code)
+        return code
+
+    def native(self, native):
+        """Name of the native function in the generated code"""
+        if native not in self.natives:
+            self.natives.append(native)
+        return '_n%d' % self.natives.index(native)
+
+    def lazy(self, name, args):
+        """Python code calculating only the needed arguments of if, and, or; None for other calls"""
+        if name == 'if' and len(args) == 3:
+            return '(%s if %s else %s)' % (args[1], args[0], args[2])
+        elif name in ('and', 'or') and args:
+            return '(1 if %s else 0)' % (' %s ' % name).join('(%s)' % arg for arg in args)
+        return None
+
+
+class ExpProgram(object):
+    """Flat postfix program compiled from syntax trees, run by a stack machine.
+
+    code holds three integers per instruction: the opcode and two operands.
+    Numeric literals are in the constants pool and identifiers in the names
+    table, both indexed by the operands. functions holds the programs of the
+    user-defined functions the main program calls. A program keeps no reference
+    to a FatExpression, so it can be copied, compared, hashed and pickled. memo
+    is the ExpMemo of a pure function (see addFunctions), set when assembling;
+    it is not copied, compared or pickled.
+    """
+    __slots__ = ('name', 'code', 'constants', 'names', 'functions', 'argCount', 'memo', '_instructions')
+
+    def __init__(self, name='', argCount=0):
+        self.name = name
+        self.argCount = argCount
+        self.code = array('l')
+        self.constants = array('d')
+        self.names = ()
+        self.functions = ()
+        self.memo = None
+        self._instructions = None
+
+    def __repr__(self):
+        return '<ExpProgram: %s %d instructions>' % (self.name, len(self.code) // 3)
+
+    def _key(self):
+        return (self.name, self.argCount, self.code.tobytes(), self.constants.tobytes(),
+                self.names, self.functions)
+
+    def __eq__(self, other):
+        return isinstance(other, ExpProgram) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __getstate__(self):
+        return self._key()
+
+    def __setstate__(self, state):
+        self.name, self.argCount, code, constants, self.names, self.functions = state
+        self.code = array('l')
+        self.code.frombytes(code)
+        self.constants = array('d')
+        self.constants.frombytes(constants)
+        self.memo = None
+        self._instructions = None
+
+    def _decode(self):
+        """The instructions as (opcode, operand, b) tuples, read once per program: the
+        operand is the constant, the name or the instruction index of a jump"""
+        code = self.code
+        instructions = []
+        for pc in range(0, len(code), 3):
+            opcode, a, b = code[pc], code[pc+1], code[pc+2]
+            if opcode == opNumeric:
+                a = self.constants[a]
+            elif opcode in (opVariable, opCall, opCallNative, opLocal, opStore):
+                a = self.names[a]
+            elif opcode in (opJump, opJumpFalse, opJumpTrue):
+                a //= 3
+            instructions.append((opcode, a, b))
+        self._instructions = tuple(instructions)
+        return self._instructions
+
+    def run(self, owner, frame=None, functions=None):
+        """Runs the program for owner (a FatExpression); frame holds the arguments of a function"""
+
+        if functions is None:
+            functions = self.functions
+
+        instructions = self._instructions
+        if instructions is None:
+            instructions = self._decode()
+        natives = owner.natives
+        variables = owner.variables
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        value = 0.0
+        pc = 0
+        end = len(instructions)
+
+        # the opcodes are tested from the most to the least frequent
+        while pc < end:
+            opcode, a, b = instructions[pc]
+            pc += 1
+
+            if opcode == opNumeric:
+                push(a)
+
+            elif opcode == opVariable:
+                result = variables.get(a)
+                if result is None:
+                    # not a variable any more: resolve it like FatExpression.evaluate
+                    result = owner.evaluate(a, stack[len(stack)-b:])
+                    if result is None:
+                        raise Exception(ERROR_UNDECLARED % a)
+                if b:
+                    del stack[-b:]
+                push(result)
+
+            elif opcode == opAdd:
+                right = pop()
+                stack[-1] = float(stack[-1]) + float(right)
+
+            elif opcode == opSubtract:
+                right = pop()
+                stack[-1] = float(stack[-1]) - float(right)
+
+            elif opcode == opMultiply:
+                right = pop()
+                stack[-1] = float(stack[-1]) * float(right)
+
+            elif opcode == opDivide:
+                right = pop()
+                stack[-1] = float(stack[-1]) / float(right)
+
+            elif opcode == opArgument:
+                if b:
+                    del stack[-b:]
+                push(frame[a])
+
+            elif opcode == opCallNative:
+                if b:
+                    args = stack[-b:]
+                    del stack[-b:]
+                else:
+                    args = []
+                push(natives[a].function(*args))
+
+            elif opcode == opCallFunction:
+                if b:
+                    args = stack[-b:]
+                    del stack[-b:]
+                else:
+                    args = []
+                function = functions[a]
+                memo = function.memo
+                if memo is None:
+                    push(function.run(owner, args, functions))
+                    continue
+                # pure function: the results are kept by ExpFunction.memo (see addFunctions)
+                key = tuple(args)
+                result = memo.find(key)
+                if result is MISSING:
+                    result = function.run(owner, args, functions)
+                    memo.put(key, result)
+                push(result)
+
+            elif opcode == opLocal:
+                if b:
+                    del stack[-b:]
+                push(owner._locals[a])
+
+            elif opcode == opJumpFalse:
+                # b selects the test of & (equal to 1) instead of the one of and() and if()
+                test = pop()
+                if (float(test) != 1) if b else not bool(test):
+                    pc = a
+
+            elif opcode == opJump:
+                pc = a
+
+            elif opcode == opJumpTrue:
+                test = pop()
+                if (float(test) == 1) if b else bool(test):
+                    pc = a
+
+            elif opcode >= opGreater and opcode <= opEqual:
+                right = pop()
+                left = stack[-1]
+                if opcode == opGreater:
+                    stack[-1] = 1 if left > right else 0
+                elif opcode == opLess:
+                    stack[-1] = 1 if left < right else 0
+                elif opcode == opLessEqual:
+                    stack[-1] = 1 if left <= right else 0
+                elif opcode == opGreaterEqual:
+                    stack[-1] = 1 if left >= right else 0
+                elif opcode == opDifferent:
+                    stack[-1] = 1 if left != right else 0
+                else:
+                    stack[-1] = 1 if left == right else 0
+
+            elif opcode == opLine:
+                value = pop()
+                owner._value = value
+                owner._value_old = value
+
+            elif opcode == opStore:
+                owner._locals[a] = stack[-1]
+
+            elif opcode == opCall:
+                if b:
+                    args = stack[-b:]
+                    del stack[-b:]
+                else:
+                    args = []
+                result = owner.evaluate(a, args)
+                if result is None:
+                    raise Exception(ERROR_UNDECLARED % a)
+                push(result)
+
+            elif opcode == opPower:
+                right = pop()
+                stack[-1] = float(stack[-1]) ** float(right)
+
+            elif opcode >= opAnd and opcode <= opXor:
+                right = float(pop())
+                left = float(stack[-1])
+                if opcode == opAnd:
+                    stack[-1] = 1 if left == 1 and right == 1 else 0
+                elif opcode == opOr:
+                    stack[-1] = 1 if left == 1 or right == 1 else 0
+                else:
+                    stack[-1] = 1 if (left == 1 and right == 0) or (left == 0 and right == 1) else 0
+
+            elif opcode == opNegate:
+                stack[-1] = stack[-1]*(-1)
+
+            elif opcode == opModule:
+                right = pop()
+                stack[-1] = int(float(stack[-1])) % int(float(right))
+
+            elif opcode == opFactorial:
+                stack[-1] = math.factorial(int(float(stack[-1])))
+
+            elif opcode == opNot:
+                stack[-1] = 0 if int(float(stack[-1])) == 1 else 1
+
+            elif opcode == opOldValue:
+                push(owner._value_old)
+
+            elif opcode == opTrue:
+                push(1)
+
+            elif opcode == opFalse:
+                push(0)
+
+            else:
+                raise Exception(ERROR_PROGRAM_OPCODE % opcode)
+
+        if frame is not None:
+            return stack[-1]
+        return value
+
+
+class ExpAssembler(object):
+    """Compiles the syntax trees of a FatExpression into an ExpProgram.
+
+    Identifiers resolve like in ExpCodeGen: arguments of user-defined functions,
+    variables assigned in a previous line and input variables are read
+    directly (a missing input variable is resolved at run time), user-defined
+    and native functions get their own call opcodes, if, and, or, & and | jump
+    over the arguments they do not need and every other name is resolved at
+    run time by FatExpression.evaluate. With eoEventFirst all other names are
+    resolved at run time.
+    """
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.eventFirst = owner.evaluateOrder == eoEventFirst
+        self.builtins = owner._evaluates[:1] == [owner.evaluateCustom]
+        self.functions = []
+
+    def assemble(self, lines):
+        program = ExpProgram()
+        self.programAssigned = set(variable for variable, tree in lines if variable)
+        state = self._state()
+        assigned = set()
+
+        for variable, tree in lines:
+            self.emit(tree, None, assigned, program, state)
+            if variable:
+                self._instruction(program, opStore, self._name(program, state, variable))
+                assigned.add(variable)
+            self._instruction(program, opLine)
+
+        program.names = tuple(state['names'])
+
+        bodies = []
+        while len(bodies) < len(self.functions):
+            function = self.functions[len(bodies)]
+            body = ExpProgram(function.name.lower(), len(function.args))
+            body.memo = function.memo
+            bodyState = self._state()
+            self.emit(function.tree, function, None, body, bodyState)
+            body.names = tuple(bodyState['names'])
+            bodies.append(body)
+
+        program.functions = tuple(bodies)
+        return program
+
+    def _state(self):
+        return {'names': [], 'nameIndex': {}, 'constantIndex': {}}
+
+    def _instruction(self, program, opcode, a=0, b=0):
+        program.code.extend((opcode, a, b))
+
+    def _name(self, program, state, name):
+        index = state['nameIndex'].get(name)
+        if index is None:
+            index = state['nameIndex'][name] = len(state['names'])
+            state['names'].append(name)
+        return index
+
+    def _constant(self, program, state, value):
+        index = state['constantIndex'].get(value)
+        if index is None:
+            index = state['constantIndex'][value] = len(program.constants)
+            program.constants.append(value)
+        return index
+
+    def _jump(self, program, opcode, test=0):
+        """Appends a jump and returns its position, for _target"""
+        self._instruction(program, opcode, -1, test)
+        return len(program.code) - 3
+
+    def _target(self, program, position):
+        """Makes the jump at position go to the next instruction"""
+        program.code[position + 1] = len(program.code)
+
+    def _shortCircuit(self, nodes, isAnd, test, function, assigned, program, state):
+        """and, or (test 0, truth value) and &, | (test 1, equal to 1) stopping at the deciding node"""
+        jumps = []
+        for node in nodes:
+            self.emit(node, function, assigned, program, state)
+            jumps.append(self._jump(program, opJumpFalse if isAnd else opJumpTrue, test))
+        self._instruction(program, opTrue if isAnd else opFalse)
+        end = self._jump(program, opJump)
+        for position in jumps:
+            self._target(program, position)
+        self._instruction(program, opFalse if isAnd else opTrue)
+        self._target(program, end)
+
+    def lazy(self, node, function, assigned):
+        """Whether node calls the builtin if (3 arguments), and or or (1 or more arguments)"""
+        name = node.value
+        argCount = len(node.childRight)
+        if name not in LAZY_FUNCTIONS or not self.builtins or argCount == 0:
+            return False
+        if name == 'if' and argCount != 3:
+            return False
+        if function is not None and name in function.argIndex:
+            return False
+        if self.eventFirst:
+            return True
+        return (assigned is None or name not in assigned) and self.owner.findFunction(name) is None
+
+    def _function(self, function):
+        if function not in self.functions:
+            self.functions.append(function)
+        return self.functions.index(function)
+
+    def emit(self, node, function, assigned, program, state):
+        """Appends the instructions of node; assigned is None inside user-defined functions"""
+
+        opcode = node.opcode
+
+        if opcode == opNumeric:
+            self._instruction(program, opNumeric, self._constant(program, state, node.value))
+
+        elif opcode == opIdentifier:
+            if self.lazy(node, function, assigned):
+                args = node.childRight
+                if node.value == 'if':
+                    self.emit(args[0], function, assigned, program, state)
+                    second = self._jump(program, opJumpFalse)
+                    self.emit(args[1], function, assigned, program, state)
+                    end = self._jump(program, opJump)
+                    self._target(program, second)
+                    self.emit(args[2], function, assigned, program, state)
+                    self._target(program, end)
+                else:
+                    self._shortCircuit(args, node.value == 'and', 0, function, assigned, program, state)
+                return
+            for child in node.childRight:
+                self.emit(child, function, assigned, program, state)
+            self.identifier(node, function, assigned, program, state)
+
+        elif opcode in (opAnd, opOr):
+            self._shortCircuit(node.childLeft + node.childRight, opcode == opAnd, 1,
+                               function, assigned, program, state)
+
+        elif opcode in (opOldValue, opTrue):
+            self._instruction(program, opcode)
+
+        elif opcode in (opFalse, opNone):
+            self._instruction(program, opFalse)
+
+        elif opcode == opLocal:
+            self._instruction(program, opLocal, self._name(program, state, node.value))
+
+        elif opcode == opStore:
+            self.emit(node.childRight[0], function, assigned, program, state)
+            self._instruction(program, opStore, self._name(program, state, node.value))
+
+        else:
+            for child in node.childLeft + node.childRight:
+                self.emit(child, function, assigned, program, state)
+            self._instruction(program, opcode)
+
+    def identifier(self, node, function, assigned, program, state):
+        name = node.value
+        argCount = len(node.childRight)
+
+        if function is not None and name in function.argIndex:
+            self._instruction(program, opArgument, function.argIndex[name], argCount)
+            return
+
+        if not self.eventFirst:
+            if assigned is not None and name in assigned:
+                self._instruction(program, opLocal, self._name(program, state, name), argCount)
+                return
+
+            # inside functions the assignments of the text are seen depending on the calling line
+            if (assigned is not None or name not in self.programAssigned) \
+                    and self.owner.expParser.findVariable(name) is not None:
+                self._instruction(program, opVariable, self._name(program, state, name), argCount)
+                return
+
+            udf = self.owner.findFunction(name)
+            if udf is not None and len(udf.args) == argCount:
+                self._instruction(program, opCallFunction, self._function(udf), argCount)
+                return
+
+            native = self.owner.natives.get(name) if udf is None and self.builtins else None
+            if native is not None and native.accepts(argCount):
+                self._instruction(program, opCallNative, self._name(program, state, name), argCount)
+                return
+
+        self._instruction(program, opCall, self._name(program, state, name), argCount)
+
+
+class ExpGraph(object):
+    """Dependency graph of the compiled lines of a FatExpression, recalculating only what changed.
+
+    Every line depends on the input variables it reads (also inside the
+    user-defined functions it calls), on the lines assigning the names it reads
+    and on the previous line when it reads _. The lines run in order: a line is
+    recalculated when one of its variables or one of the lines it depends on
+    changed, otherwise its last value is reused. Lines calling impure native
+    functions (random) or names resolved by callbacks, and a first line reading
+    _, are always recalculated.
+    """
+
+    def __init__(self, owner, program, resolved=None):
+        self.owner = owner
+        self.program = program
+        self.resolved = program if resolved is None else resolved
+        self.valid = False
+        self.recalculated = 0
+        self.inputs = []      # input variable names of each line
+        self.depends = []     # indices of the lines each line depends on
+        self.volatile = []    # lines always recalculated
+        self.stores = []      # shared subtrees (opStore) kept by each line
+        self.results = [None] * len(program)
+        self.snapshot = {}
+
+        external = any(evaluate != owner.evaluateCustom for evaluate in owner._evaluates)
+        self.builtins = owner._evaluates[:1] == [owner.evaluateCustom]
+        self.eventFirst = owner.evaluateOrder == eoEventFirst and external
+
+        assigned = {}
+        for index, (variable, tree) in enumerate(program):
+            inputs, depends, stores = set(), set(), []
+            volatile = self._collect(tree, None, index, assigned, inputs, depends, stores, set())
+            self.inputs.append(frozenset(inputs))
+            self.depends.append(tuple(sorted(depends)))
+            self.volatile.append(volatile)
+            self.stores.append(tuple(stores))
+            for name in stores:
+                assigned[name] = index
+            if variable:
+                assigned[variable] = index
+
+        self.names = sorted(set().union(*self.inputs)) if self.inputs else []
+
+    def _collect(self, tree, function, index, assigned, inputs, depends, stores, visited):
+        """Adds the dependencies of tree to the sets; returns True when the line is volatile"""
+        owner = self.owner
+        volatile = False
+
+        for node in tree.walk():
+            opcode = node.opcode
+
+            if opcode == opOldValue:
+                if index == 0:
+                    volatile = True
+                else:
+                    depends.add(index - 1)
+
+            elif opcode == opStore:
+                stores.append(node.value)
+
+            elif opcode == opLocal:
+                if node.value in assigned:
+                    depends.add(assigned[node.value])
+
+            elif opcode == opIdentifier:
+                name = node.value
+                if function is not None and name in function.argIndex:
+                    continue
+                if self.eventFirst:
+                    volatile = True
+                    continue
+                if name in assigned:
+                    depends.add(assigned[name])
+                    continue
+                if owner.expParser.findVariable(name) is not None:
+                    inputs.add(name)
+                    continue
+                udf = owner.findFunction(name)
+                if udf is not None:
+                    if udf not in visited:
+                        visited.add(udf)
+                        volatile = self._collect(udf.tree, udf, index, assigned, inputs, depends,
+                                                 [], visited) or volatile
+                elif self.builtins and name in owner.natives:
+                    volatile = volatile or not owner.natives[name].pure
+                else:
+                    # resolved by the callbacks unless it becomes a variable
+                    inputs.add(name)
+
+        return volatile
+
+    def _same(self, a, b):
+        return type(a) is type(b) and a == b
+
+    def execute(self):
+        """Runs the lines, recalculating the ones that depend on a changed variable"""
+        owner = self.owner
+        findVariable = owner.expParser.findVariable
+
+        changedNames = set()
+        for name in self.names:
+            value = findVariable(name)
+            if value is None or not self._same(value, self.snapshot.get(name)):
+                changedNames.add(name)
+                self.snapshot[name] = value
+
+        owner._locals = local = {}
+        changed = set()
+        self.recalculated = 0
+        valid, self.valid = self.valid, False
+
+        for index, (variable, tree) in enumerate(self.resolved):
+            result = self.results[index]
+
+            if not valid or self.volatile[index] or not changedNames.isdisjoint(self.inputs[index]) \
+                    or not changed.isdisjoint(self.depends[index]):
+                value = tree.calculate(owner)
+                stored = tuple(local[name] for name in self.stores[index])
+                self.recalculated += 1
+                if result is None or not self._same(value, result[0]) \
+                        or not all(map(self._same, stored, result[1])):
+                    changed.add(index)
+                    self.results[index] = (value, stored)
+            else:
+                value, stored = result
+                for name, storedValue in zip(self.stores[index], stored):
+                    local[name] = storedValue
+
+            owner._value = value
+            owner._value_old = value
+
+            if variable:
+                local[variable] = value
+
+        self.valid = True
+
+
+class ExpCompiled(object):
+    """Compiled text of a FatExpression that threads can share.
+
+    Holds copies of the lines, variables, user-defined functions, natives and
+    callbacks of the owner when created; later changes to the owner do not
+    reach it and its attributes can not be set. evaluate() keeps the
+    assignments and _ of each call in an ExpContext of its own, so one object
+    may be evaluated by many threads at once, as long as the callbacks are
+    thread-safe. The lines are calculated by the tree walker.
+    """
+
+    __slots__ = ('text', 'evaluateOrder', 'variables', 'functions', 'natives', '_evaluates', '_pureEvaluates',
+                 '_lines', '_state')
+
+    def __init__(self, owner):
+        if not owner.compiled:
+            owner.compile()
+
+        init = object.__setattr__
+        init(self, '_state', (list(owner._text), owner.evaluateOrder, owner.optimize, owner.inlineLimit,
+                              dict(owner.variables),
+                              [(function.text, None if function.memo is None else function.memo.capacity)
+                               for function in owner.functions.values()],
+                              [(None if evaluate == owner.evaluateCustom else evaluate,
+                                evaluate in owner._pureEvaluates) for evaluate in owner._evaluates],
+                              dict((name, native) for name, native in owner.natives.items()
+                                   if nativeFunctions.get(name) is not native)))
+        init(self, 'text', owner.text)
+        init(self, 'evaluateOrder', owner.evaluateOrder)
+        init(self, 'variables', MappingProxyType(dict(owner.variables)))
+        init(self, 'natives', MappingProxyType(dict(owner.natives)))
+
+        functions = {}
+        for name, function in owner.functions.items():
+            functions[name] = ExpFunction(self)
+            functions[name]._setAsString(function.text)
+            if function.memo is not None:
+                functions[name].memo = ExpMemo(None, function.memo.capacity)
+        init(self, 'functions', MappingProxyType(functions))
+
+        init(self, '_evaluates', [self.evaluateCustom if evaluate == owner.evaluateCustom else evaluate
+                                  for evaluate in owner._evaluates])
+        init(self, '_pureEvaluates', [evaluate for evaluate in self._evaluates if evaluate in owner._pureEvaluates])
+        init(self, '_lines', tuple(ExpResolver(self).resolve(owner._program)))
+
+    def __setattr__(self, name, value):
+        raise Exception(ERROR_COMPILED_READONLY % name)
+
+    def __getstate__(self):
+        """The source of the text, functions and settings; callbacks and natives not
+        registered by registerNative are pickled by reference"""
+        return self._state
+
+    def __setstate__(self, state):
+        text, evaluateOrder, optimize, inlineLimit, variables, functions, evaluates, natives = state
+        owner = FatExpression()
+        owner.clearEvaluate()
+        for evaluate, pure in evaluates:
+            owner.addEvaluate(owner.evaluateCustom if evaluate is None else evaluate, pure)
+        owner.natives.update(natives)
+        for function, capacity in functions:
+            owner.addFunctions([function], capacity is not None, capacity or 0)
+        owner.addVariables(variables)
+        owner.evaluateOrder = evaluateOrder
+        owner.optimize = optimize
+        owner.inlineLimit = inlineLimit
+        owner.text = text
+        ExpCompiled.__init__(self, owner)
+
+    def __repr__(self):
+        return '<ExpCompiled: %s>' % self.text
+
+    def findFunction(self, name):
+        return self.functions.get(name.strip().lower())
+
+    def evaluateCustom(self, text, args):
+        """Calls the native function named text"""
+        native = self.natives.get(text)
+        if native is not None:
+            return native.call(args)
+
+    def evaluate(self, variables=None):
+        """Calculates the lines and returns the value of the last one.
+
+        variables (dict, list or string, as in addVariables) are added to the
+        variables of this object for this call only; _ starts equal to 0.
+        """
+        return self._run(ExpContext(self, variables))
+
+    async def evaluateAsync(self, variables=None, limit=None):
+        """Calculates the lines as evaluate(); the callbacks may be coroutine functions.
+
+        The callback calls always calculated whose arguments depend only on
+        numbers and variables are awaited first, together with asyncio.gather,
+        once per occurrence unless the callback is pure;
+        limit caps how many callbacks run at a time. The lines are then
+        calculated in a thread of the default executor, which waits for the
+        other callback calls one by one.
+        """
+        loop = asyncio.get_running_loop()
+        context = ExpAsyncContext(self, variables, loop, asyncio.Semaphore(limit) if limit else None)
+
+        calls = []
+        for variable, tree in self._lines:
+            context.collect(tree, calls)
+        calls = [call for index, call in enumerate(calls)
+                 if call not in calls[:index] or not isPureCallback(self, call[0])]
+        values = await asyncio.gather(*[context.resolve(name, list(args)) for name, args in calls])
+        for call, value in zip(calls, values):
+            context.prefetched.setdefault(call, []).append(value)
+
+        return await loop.run_in_executor(None, self._run, context)
+
+    def _run(self, context):
+        value = 0.0
+
+        for variable, tree in self._lines:
+
+            value = tree.calculate(context)
+
+            context._value_old = value
+
+            if variable:
+                context._locals[variable] = value
+
+        return value
+
+    def evaluateMany(self, rows, typecode='d'):
+        """Evaluates once per row, as FatExpression.evaluateMany; rows is an iterable
+        of variable dicts or a dict of equal-length columns"""
+        results = array(typecode) if typecode else []
+        for variables in iterRows(rows, self.variables):
+            context = ExpContext(self)
+            context.variables = variables
+            results.append(self._run(context))
+        return results
+
+
+class ExpContext(object):
+    """Variables, assignments and _ of one evaluation of an ExpCompiled or an ExpPack"""
+
+    __slots__ = ('compiled', 'variables', '_locals', '_value', '_value_old')
+
+    def __init__(self, compiled, variables=None):
+        self.compiled = compiled
+        if variables:
+            parser = ExpParser()
+            parser._variables = dict(compiled.variables)
+            parser.addVariables(variables)
+            self.variables = parser._variables
+        else:
+            self.variables = compiled.variables
+        self._locals = {}
+        self._value = 0.0
+        self._value_old = 0.0
+
+    @property
+    def natives(self):
+        return self.compiled.natives
+
+    def evaluate(self, text, args):
+        compiled = self.compiled
+        text = text.strip().lower()
+        if compiled.evaluateOrder == eoEventFirst:
+            value = self._callEvaluates(text, args)
+            if value is not None:
+                return value
+
+        if text in self._locals:
+            return self._locals[text]
+
+        value = self.variables.get(text)
+        if value is not None:
+            return value
+
+        function = compiled.findFunction(text)
+        if function:
+            return function.call(args, self)
+
+        if compiled.evaluateOrder == eoInternalFirst:
+            return self._callEvaluates(text, args)
+
+    def evaluateLazy(self, text, nodes, owner=None):
+        """Calculates the builtins if, and, or as FatExpression.evaluateLazy"""
+        compiled = self.compiled
+        if compiled._evaluates[:1] != [compiled.evaluateCustom]:
+            return None
+        if compiled.evaluateOrder == eoInternalFirst and (text in self._locals or compiled.findFunction(text)
+                                                           or self.variables.get(text) is not None):
+            return None
+        return calculateLazy(text, nodes, self if owner is None else owner)
+
+    def _callEvaluates(self, text, args):
+        for evaluate in self.compiled._evaluates:
+            value = evaluate(text, args)
+            if value is not None:
+                return value
+
+
+class ExpAsyncContext(ExpContext):
+    """ExpContext of ExpCompiled.evaluateAsync; the callbacks may return awaitables"""
+
+    __slots__ = ('loop', 'semaphore', 'prefetched')
+
+    # opcodes calculated without callbacks, given that the variables and natives they read exist
+    INDEPENDENT = frozenset((opNumeric, opTrue, opFalse, opNone, opVariable, opCallNative) +
+                            tuple(range(opAdd, opEqual + 1)))
+
+    def __init__(self, compiled, variables, loop, semaphore=None):
+        ExpContext.__init__(self, compiled, variables)
+        self.loop = loop
+        self.semaphore = semaphore
+        self.prefetched = {}
+
+    def independent(self, node):
+        """Whether node is calculated without callbacks"""
+        for child in node.walk():
+            if child.opcode not in self.INDEPENDENT:
+                return False
+            if child.opcode == opVariable and child.value not in self.variables:
+                return False
+            if child.opcode == opCallNative and (not child.value[1].pure or child.value[0] in self.variables):
+                return False
+        return True
+
+    def collect(self, node, calls):
+        """Appends to calls the (name, args) of the callback calls of node that are always
+        calculated and have independent arguments"""
+        opcode = node.opcode
+        name = node.value[0] if opcode in (opCall, opCallNative) else node.value
+        builtins = self.compiled._evaluates[:1] == [self.compiled.evaluateCustom]
+
+        if opcode == opCallNative and name in LAZY_FUNCTIONS or \
+                opcode == opIdentifier and builtins and name in LAZY_FUNCTIONS:
+            children = node.childRight[:1]
+        elif opcode == opAnd or opcode == opOr:
+            children = node.childLeft
+        elif opcode == opIdentifier or opcode == opCall and name not in self.variables:
+            if all(self.independent(child) for child in node.childRight):
+                calls.append((name, tuple(child.calculate(self) for child in node.childRight)))
+                return
+            children = node.childRight
+        else:
+            children = node.childLeft + node.childRight
+
+        for child in children:
+            self.collect(child, calls)
+
+    async def resolve(self, text, args):
+        """Calls the callbacks as _callEvaluates, awaiting the awaitable results"""
+        semaphore = self.semaphore
+        if semaphore is not None:
+            await semaphore.acquire()
+        try:
+            for evaluate in self.compiled._evaluates:
+                value = evaluate(text, args)
+                if inspect.isawaitable(value):
+                    value = await value
+                if value is not None:
+                    return value
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+    def _callEvaluates(self, text, args):
+        values = self.prefetched.get((text, tuple(args)))
+        if values:
+            # a pure call is prefetched once, the others once per occurrence
+            return values[0] if isPureCallback(self.compiled, text) else values.pop(0)
+        return asyncio.run_coroutine_threadsafe(self.resolve(text, args), self.loop).result()
+
+
+def evaluateThreaded(jobs, maxWorkers=None):
+    """Evaluates (expression, variables) jobs with a pool of threads; returns the values in order.
+
+    expression is an ExpCompiled or a FatExpression, compiled here once with
+    compileExpression(). The threads only run at the same time while the
+    callbacks release the GIL (I/O, extensions).
+    """
+    compiled = {}
+    tasks = []
+    for expression, variables in jobs:
+        if not isinstance(expression, ExpCompiled):
+            if expression not in compiled:
+                compiled[expression] = expression.compileExpression()
+            expression = compiled[expression]
+        tasks.append((expression, variables))
+
+    with ThreadPoolExecutor(maxWorkers) as executor:
+        futures = [executor.submit(expression.evaluate, variables) for expression, variables in tasks]
+        return [future.result() for future in futures]
+
+
+def iterRows(rows, base=None):
+    """Iterates rows (dicts or a dict of equal-length columns) as variable dicts
+    adding the values of each row, as floats, to a copy of base"""
+    base = base or {}
+
+    if isinstance(rows, dict):
+        names = [name.strip().lower() for name in rows]
+        columns = list(rows.values())
+        if len(set(len(column) for column in columns)) > 1:
+            raise Exception(ERROR_BATCH_COLUMNS)
+        for values in zip(*columns):
+            variables = dict(base)
+            for name, value in zip(names, values):
+                variables[name] = float(value)
+            yield variables
+    else:
+        names = {}
+        for row in rows:
+            variables = dict(base)
+            for key, value in row.items():
+                name = names.get(key)
+                if name is None:
+                    name = names[key] = key.strip().lower()
+                variables[name] = float(value)
+            yield variables
+
+
+def chunkRows(rows, size):
+    """Splits rows (see iterRows) in chunks of size rows of the same kind"""
+    if isinstance(rows, dict):
+        columns = list(rows.values())
+        if len(set(len(column) for column in columns)) > 1:
+            raise Exception(ERROR_BATCH_COLUMNS)
+        count = len(columns[0]) if columns else 0
+        for start in range(0, count, size):
+            yield dict((name, column[start:start + size]) for name, column in rows.items())
+    else:
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, size))
+            if not chunk:
+                break
+            yield chunk
+
+
+_workerCompiled = None
+
+
+def _initWorker(compiled):
+    global _workerCompiled
+    _workerCompiled = compiled
+
+
+def _evaluateWorker(rows, typecode):
+    return _workerCompiled.evaluateMany(rows, typecode)
+
+
+def evaluateProcesses(expression, rows, chunkSize=None, maxWorkers=None, typecode='d'):
+    """Evaluates expression once per row with a pool of processes; returns the results in order.
+
+    expression is an ExpCompiled or a FatExpression, compiled here with
+    compileExpression(); it is pickled once per process, rows are sent in
+    chunks of chunkSize (default about four chunks per process). Results are
+    array(typecode) or, when typecode is None, a list; every row starts with _
+    equal to 0.
+    """
+    if not isinstance(expression, ExpCompiled):
+        expression = expression.compileExpression()
+
+    if maxWorkers is None:
+        maxWorkers = os.cpu_count() or 1
+    if chunkSize is None:
+        try:
+            count = len(next(iter(rows.values()))) if isinstance(rows, dict) and rows else len(rows)
+            chunkSize = -(-count // (maxWorkers * 4))
+        except TypeError:
+            chunkSize = 4096
+
+    result = array(typecode) if typecode else []
+    with ProcessPoolExecutor(maxWorkers, initializer=_initWorker, initargs=(expression,)) as executor:
+        for results in executor.map(_evaluateWorker, chunkRows(rows, max(1, int(chunkSize))),
+                                    repeat(typecode)):
+            result.extend(results)
+    return result
+
+
+class ExpPack(object):
+    """Rule pack loaded by loadPack: named expressions compiled into ExpProgram.
+
+    The file is mapped read-only with mmap and the program of an expression
+    is built on first use over the mapped buffer, without copying its code
+    and constants, so processes loading the same pack share its pages. The
+    user-defined functions are parsed only when a program calls one by name.
+    Natives and callbacks are not saved: register them with addNative and
+    addEvaluate before evaluating. A pack can be shared by threads.
+    """
+
+    def __init__(self, path, verify=True):
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size < PACK_HEADER.size:
+                raise Exception(ERROR_PACK_FORMAT % path)
+            self._buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, version, reserved, checksum, offset, size = PACK_HEADER.unpack_from(self._buffer)
+            if magic != PACK_MAGIC:
+                raise Exception(ERROR_PACK_FORMAT % path)
+            if version != PACK_VERSION:
+                raise Exception(ERROR_PACK_VERSION % (version, PACK_VERSION))
+            with memoryview(self._buffer) as view:
+                if verify and zlib.crc32(view[PACK_HEADER.size:]) != checksum:
+                    raise Exception(ERROR_PACK_CHECKSUM % path)
+                directory = json.loads(bytes(view[offset:offset + size]).decode('utf-8'))
+        except Exception:
+            self._buffer.close()
+            raise
+        self.path = path
+        self.evaluateOrder = directory['evaluateOrder']
+        self.variables = MappingProxyType(directory['variables'])
+        self.natives = dict(nativeFunctions)
+        self.functions = {}
+        self._functionTexts = directory['functions']
+        self._expressions = directory['expressions']
+        self._records = directory['programs']
+        self._programs = {}
+        self._evaluates = [self.evaluateCustom]
+
+    def __len__(self):
+        return len(self._expressions)
+
+    def __contains__(self, name):
+        return name in self._expressions
+
+    def __repr__(self):
+        return '<ExpPack: %s %d expressions>' % (self.path, len(self._expressions))
+
+    def names(self):
+        return list(self._expressions)
+
+    def addEvaluate(self, evaluate):
+        self._evaluates.append(evaluate)
+
+    def addNative(self, name, function, argCount=None, pure=True, vector=None):
+        native = ExpNative(name, function, argCount, pure, vector)
+        self.natives[native.name] = native
+        return native
+
+    def evaluateCustom(self, text, args):
+        native = self.natives.get(text)
+        if native is not None:
+            return native.call(args)
+
+    def findFunction(self, name):
+        name = name.strip().lower()
+        function = self.functions.get(name)
+        if function is None and name in self._functionTexts:
+            function = ExpFunction(self)
+            function._setAsString(self._functionTexts[name])
+            self.functions[name] = function
+        return function
+
+    def program(self, name):
+        """The ExpProgram of the expression name"""
+        index = self._expressions.get(name)
+        if index is None:
+            raise Exception(ERROR_PACK_EXPRESSION % name)
+        return self._program(index)
+
+    def _program(self, index):
+        program = self._programs.get(index)
+        if program is None:
+            name, argCount, code, codeCount, constants, constantCount, names, functions = self._records[index]
+            program = ExpProgram(name, argCount)
+            program.code = self._array(code, codeCount, 'q')
+            program.constants = self._array(constants, constantCount, 'd')
+            program.names = tuple(intern(name) for name in names)
+            program.functions = tuple(self._program(function) for function in functions)
+            self._programs[index] = program
+        return program
+
+    def _array(self, offset, count, typecode):
+        view = memoryview(self._buffer)[offset:offset + count * 8].cast(typecode)
+        if sys.byteorder == 'little':
+            return view
+        result = array(typecode, view)
+        result.byteswap()
+        return result
+
+    def evaluate(self, name, variables=None):
+        """Runs the program of the expression name with variables (as ExpCompiled.evaluate)"""
+        return self.program(name).run(ExpContext(self, variables))
+
+    def close(self):
+        """Unmaps the file; fails while programs built from it are still referenced"""
+        self._programs = {}
+        self._buffer.close()
+
+
+def savePack(path, expressions, functions=(), variables=None, evaluateOrder=eoInternalFirst,
+             optimize=False, inlineLimit=0):
+    """Compiles the named expressions (dict of name: text) and writes them to a rule pack.
+
+    The user-defined functions and variables are the ones the expressions
+    are compiled with (see FatExpression); identical function programs are
+    written once. Load the pack with loadPack.
+    """
+    owner = FatExpression()
+    owner.addFunctions(functions)
+    if variables:
+        owner.addVariables(variables)
+    owner.evaluateOrder = evaluateOrder
+    owner.optimize = optimize
+    owner.inlineLimit = inlineLimit
+
+    data = bytearray(PACK_HEADER.size)
+    data.extend(bytes(-len(data) % 8))
+    records = []
+    ids = {}
+
+    def write(values, typecode):
+        values = array(typecode, values)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        offset = len(data)
+        data.extend(values.tobytes())
+        return offset, len(values)
+
+    def add(program, functions):
+        key = (program, tuple(functions))
+        if key not in ids:
+            code, codeCount = write(program.code, 'q')
+            constants, constantCount = write(program.constants, 'd')
+            ids[key] = len(records)
+            records.append([program.name, program.argCount, code, codeCount, constants, constantCount,
+                            list(program.names), list(functions)])
+        return ids[key]
+
+    index = {}
+    for name, text in expressions.items():
+        owner.text = text
+        # the programs do not need the resolved trees of compile()
+        program = ExpAssembler(owner).assemble(owner._buildLines())
+        index[name] = add(program, [add(function, ()) for function in program.functions])
+
+    directory = json.dumps({
+        'evaluateOrder': evaluateOrder, 'variables': dict(owner.variables), 'expressions': index,
+        'functions': dict((name, function.text) for name, function in owner.functions.items()),
+        'programs': records,
+    }).encode('utf-8')
+    offset = len(data)
+    data.extend(directory)
+
+    checksum = zlib.crc32(memoryview(data)[PACK_HEADER.size:])
+    PACK_HEADER.pack_into(data, 0, PACK_MAGIC, PACK_VERSION, 0, checksum, offset, len(directory))
+    with open(path, 'wb') as file:
+        file.write(data)
+
+
+def loadPack(path, verify=True):
+    """Maps the rule pack written by savePack; verify checks its checksum"""
+    return ExpPack(path, verify)
+
 
 class FatExpression(object):
 
     def __init__(self):
         self.compiled      = False
-        self.evaluateOrder = eoInternalFirst
-        self.functions     = []
+        self._evaluateOrder = eoInternalFirst
+        self._optimize     = False
+        self._inlineLimit  = 0
+        self.eliminated    = 0
+        self.shared        = 0
+        self.inlined       = 0
+        self.functions     = {}
         self.expParser     = ExpParser()
         self._text         = []
         self._evaluates    = [self.evaluateCustom]
+        self.natives       = dict(nativeFunctions)
+        self._pureEvaluates = []
         self._value        = None
         self._value_old    = None
+        self._program      = []
+        self._resolved     = []
+        self._locals       = {}
+        self._executable   = None
+        self.evaluateMode  = emTree
+        self.incremental   = False
+        self._graph        = None
+
+    @property
+    def evaluateOrder(self):
+        return self._evaluateOrder
+
+    @evaluateOrder.setter
+    def evaluateOrder(self, value):
+        self._evaluateOrder = value
+        self.compiled = False
+
+    @property
+    def optimize(self):
+        """Simplify the syntax trees when compiling (see ExpOptimizer); off by default"""
+        return self._optimize
+
+    @optimize.setter
+    def optimize(self, value):
+        self._optimize = value
+        self.compiled = False
+
+    @property
+    def inlineLimit(self):
+        """Largest body, in nodes, of the user-defined functions inlined by optimize
+        (see ExpOptimizer.inline); 0, the default, inlines none"""
+        return self._inlineLimit
+
+    @inlineLimit.setter
+    def inlineLimit(self, value):
+        self._inlineLimit = max(0, int(value))
+        self.compiled = False
+
+    @property
+    def variables(self):
+        return self.expParser._variables
 
     def addVariables(self, variables):
+        names = set(self.expParser._variables)
         self.expParser.addVariables(variables)
+        shadowed = set(self.natives) | set(self.functions) if self._inlineLimit else set(self.natives)
+        if (self._optimize or self.incremental or self.functionStats()) \
+                and shadowed & (set(self.expParser._variables) - names):
+            # a variable now shadows a native or an inlined function
+            self.compiled = False
 
     def clearVariables(self):
         self.expParser._variables = {}
-
-    def addEvaluate(self, evaluate):
+        if self._optimize:
+            # names shared as variables may now resolve to callbacks
+            self.compiled = False
+
+    def addEvaluate(self, evaluate, pure=False, capacity=0, ttl=None):
+        """Adds a callback resolving names; pure callbacks return the same value for the
+        same name and arguments during an evaluation, so optimize may share their calls.
+
+        With a capacity or a ttl the callback is wrapped in an ExpMemo caching its
+        results across evaluations; returns the callback added.
+        """
+        if capacity or ttl is not None:
+            evaluate = ExpMemo(evaluate, capacity or 1024, ttl)
         self._evaluates.append(evaluate)
+        if pure:
+            self._pureEvaluates.append(evaluate)
+        self.compiled = False
+        return evaluate
 
     def clearEvaluate(self):
         self._evaluates = []
+        self._pureEvaluates = []
+        self.compiled = False
 
     def compile(self):
+        """Builds the syntax tree of every line of text, once until text changes"""
+
+        self._program = self._buildLines()
+        self._resolved = ExpResolver(self).resolve(self._program)
+
+        self._executable = None
+        self._graph = None
+        self.compiled = True
+
+    def _buildLines(self):
+        """The (variable, tree) lines of text, optimized when optimize is set"""
+
+        lines = []
 
         for text in self._text:
 
@@ -755,42 +3250,108 @@ class FatExpression(object):
             else:
                 variable, expression = ('', text.strip())
 
-            self.expParser.expression = expression
-            self.expParser.validate()
+            tree = expCache.get(expression)
+
+            lines.append((variable.lower(), tree))
+
+        self.eliminated = 0
+        self.shared = 0
+        self.inlined = 0
+        if self._optimize:
+            optimizer = ExpOptimizer(self)
+            if self._inlineLimit:
+                lines = optimizer.inline(lines, self._inlineLimit)
+            lines = optimizer.share(optimizer.optimize(lines))
+            self.eliminated = optimizer.eliminated
+            self.shared = optimizer.shared
+            self.inlined = optimizer.inlined
+
+        return lines
+
+    def compileFunction(self):
+        """Generates a Python function computing the compiled text (see ExpCodeGen)"""
+        if not self.compiled:
+            self.compile()
+        return ExpCodeGen(self, self._program).function()
+
+    def compileProgram(self):
+        """Compiles the text into a flat stack-machine program (see ExpProgram)"""
+        if not self.compiled:
+            self.compile()
+        return ExpAssembler(self).assemble(self._program)
+
+    def compileExpression(self):
+        """Returns an ExpCompiled of the text, evaluated without changing this object"""
+        return ExpCompiled(self)
+
+    async def evaluateAsync(self, variables=None, limit=None):
+        """Calculates the text with coroutine callbacks (see ExpCompiled.evaluateAsync);
+        compiles a snapshot on every call, keep an ExpCompiled to evaluate it again"""
+        return await self.compileExpression().evaluateAsync(variables, limit)
+
+    def _getExecutable(self):
+        key = self.evaluateMode
+        if self._executable is None or self._executableKey != key:
+            if self.evaluateMode == emCode:
+                self._executable = self.compileFunction()
+            else:
+                self._executable = self.compileProgram()
+            self._executableKey = key
+        return self._executable
+
+    def execute(self):
+        """Calculates the compiled lines; assignments are local to one execution"""
 
-            token = self.expParser.readFirstToken()
-            while token:
-                token = self.expParser.readNextToken()
+        if self.incremental and self.evaluateMode != emTree:
+            raise Exception(ERROR_INCREMENTAL_MODE)
 
-            tree = ExpNode(self, None, self.expParser.tokens)
+        if not self.compiled:
+            self.compile()
 
-            tree.build()
-            value = tree.calculate()
+        self._locals = {}
+
+        if self.evaluateMode == emCode:
+            value = self._getExecutable().run(self.expParser._variables, self._value_old)
+            if self._program:
+                self._value = value
+                self._value_old = value
+            return
+
+        elif self.evaluateMode == emProgram:
+            self._getExecutable().run(self)
+            return
+
+        elif self.incremental:
+            if self._graph is None:
+                self._graph = ExpGraph(self, self._program, self._resolved)
+            self._graph.execute()
+            return
+
+        for variable, tree in self._resolved:
+
+            value = tree.calculate(self)
 
             self._value = value
             self._value_old = value
 
-            self.expParser._setVariable(variable, value)
-
-        self.expParser._variables = {}
+            if variable:
+                self._locals[variable] = value
 
     def findFunction(self, name):
-        for f in self.functions:
-            function = ExpFunction(self)
-            function._setAsString(f)
-            if function.name.lower() == name.lower():
-                return function
+        return self.functions.get(name.strip().lower())
 
     def evaluate(self, text, args):
         text = text.strip().lower()
         if self.evaluateOrder == eoEventFirst:
-            for evaluate in self._evaluates:
-                value = evaluate(text, args)
-                if value is not None:
-                    return value
+            value = self._callEvaluates(text, args)
+            if value is not None:
+                return value
+
+        if text in self._locals:
+            return self._locals[text]
 
         value = self.expParser.findVariable(text)
-        if value:
+        if value is not None:
             return value
 
         function = self.findFunction(text)
@@ -798,32 +3359,193 @@ class FatExpression(object):
             return function.call(args)
 
         if self.evaluateOrder == eoInternalFirst:
-            for evaluate in self._evaluates:
-                value = evaluate(text, args)
-                if value is not None:
-                    return value
+            return self._callEvaluates(text, args)
+
+    def evaluateLazy(self, text, nodes, owner=None):
+        """Calculates the builtins if, and, or with only the arguments they need.
+
+        Returns None when text is not resolved by the builtins; the nodes are
+        calculated with owner (default self).
+        """
+        if self._evaluates[:1] != [self.evaluateCustom]:
+            return None
+        if self.evaluateOrder == eoInternalFirst and (text in self._locals or self.findFunction(text)
+                                                       or self.expParser.findVariable(text) is not None):
+            return None
+        return calculateLazy(text, nodes, self if owner is None else owner)
+
+    def _callEvaluates(self, text, args):
+        for evaluate in self._evaluates:
+            value = evaluate(text, args)
+            if value is not None:
+                return value
 
     @property
     def value(self):
         if self._value_old is None:
             self._value_old = 0.0
         self._value = 0.0
-        self.compile()
+        self.execute()
         return self._value
 
+    def _evaluateChunk(self, rows, size, typecode):
+        results = array(typecode, [0]) * size if typecode else [0.0] * size
+        base = self.expParser._variables
+        count = 0
+        try:
+            for variables in rows:
+                self.expParser._variables = variables
+                self._value = 0.0
+                self._value_old = 0.0
+                self.execute()
+                results[count] = self._value
+                count += 1
+                if count == size:
+                    break
+        finally:
+            self.expParser._variables = base
+        if count < size:
+            del results[count:]
+        return results
+
+    def evaluateChunks(self, rows, chunkSize=65536, typecode='d'):
+        """Evaluates the text once per row of variables, yielding the results in chunks.
+
+        rows is an iterable of dicts or a dict of equal-length columns; the values of
+        each row are added to the variables of this object. Results are array(typecode)
+        or, when typecode is None, lists. Every row starts with _ equal to 0.
+        """
+        if not self.compiled:
+            self.compile()
+
+        rows = iterRows(rows, self.expParser._variables)
+        size = max(1, int(chunkSize))
+
+        while True:
+            results = self._evaluateChunk(rows, size, typecode)
+            if len(results) == 0:
+                break
+            yield results
+            if len(results) < size:
+                break
+
+    def evaluateMany(self, rows, chunkSize=None, typecode='d'):
+        """Evaluates the text once per row of variables and returns all results"""
+        if chunkSize is None:
+            try:
+                if isinstance(rows, dict):
+                    chunkSize = len(next(iter(rows.values()))) if rows else 1
+                else:
+                    chunkSize = len(rows)
+            except TypeError:
+                chunkSize = 65536
+
+        result = None
+        for results in self.evaluateChunks(rows, chunkSize, typecode):
+            if result is None:
+                result = results
+            else:
+                result.extend(results)
+
+        if result is None:
+            result = array(typecode) if typecode else []
+
+        return result
+
+    def evaluateParallel(self, rows, chunkSize=None, maxWorkers=None, typecode='d'):
+        """Evaluates the text once per row with a pool of processes (see evaluateProcesses)"""
+        return evaluateProcesses(self, rows, chunkSize, maxWorkers, typecode)
+
+    def evaluateArrays(self, columns):
+        """Evaluates the text over a dict of equal-length columns with NumPy.
+
+        Returns a float64 array with one result per row; every row starts with _
+        equal to 0. With evaluateOrder eoEventFirst the callbacks can shadow any
+        name, so the rows are evaluated one by one with evaluateMany().
+        """
+        if numpy is None:
+            raise Exception(ERROR_NUMPY)
+
+        if not self.compiled:
+            self.compile()
+
+        if self.evaluateOrder == eoEventFirst:
+            return numpy.asarray(self.evaluateMany(columns), dtype=float)
+
+        return ExpVector(self, columns).run(self._program)
+
     def getBoolean(self):
         return bool(self.value)
 
     def getInteger(self):
         return int(self.value)
 
-    def addFunctions(self, functions):
+    def addNative(self, name, function, argCount=None, pure=True, vector=None):
+        """Adds (or replaces) a native function of this object, resolved like the builtins"""
+        native = ExpNative(name, function, argCount, pure, vector)
+        self.natives[native.name] = native
+        self.compiled = False
+        return native
+
+    def addFunctions(self, functions, pure=False, capacity=1024):
+        """Compiles the user-defined functions and adds them to the registry.
+
+        Pure functions keep up to capacity results by arguments in every evaluateMode
+        (see ExpMemo and functionStats); compiling raises an exception when one reads more than its
+        arguments, pure natives and other pure functions.
+        """
         if isinstance(functions, str):
             functions = functions.split(';')
-        self.functions.extend(functions)
+
+        registry = dict(self.functions)
+
+        for text in functions:
+            if text.strip() == '':
+                continue
+            function = ExpFunction(self)
+            function._setAsString(text.strip())
+            if pure:
+                function.memo = ExpMemo(None, capacity)
+            name = function.name.lower()
+            if name in registry:
+                raise Exception(ERROR_FUNCTION_DUPLICATE % function.name)
+            registry[name] = function
+
+        self._checkCycles(registry)
+        self.functions = registry
+        self.compiled = False
+
+    def _checkCycles(self, registry):
+        """Raises an exception when user-defined functions call each other in a cycle"""
+        graph = {}
+        for name, function in registry.items():
+            graph[name] = sorted(function.references() & set(registry))
+
+        done = set()
+
+        def visit(name, path):
+            if name in path:
+                cycle = path[path.index(name):] + [name]
+                raise Exception(ERROR_FUNCTION_CYCLIC % (name, ' -> '.join(cycle)))
+            if name in done:
+                return
+            path.append(name)
+            for ref in graph[name]:
+                visit(ref, path)
+            path.pop()
+            done.add(name)
+
+        for name in graph:
+            visit(name, [])
+
+    def functionStats(self):
+        """Statistics of the results kept by the pure user-defined functions"""
+        return dict((name, function.memo.stats()) for name, function in self.functions.items()
+                    if function.memo is not None)
 
     def clearFunctions(self):
-        self.functions = []
+        self.functions = {}
+        self.compiled = False
 
     @property
     def text(self):
@@ -846,102 +3568,263 @@ class FatExpression(object):
             self._text = [value]
 
     def evaluateCustom(self, text, args):
+        """Calls the native function named text (see addNative)"""
+        native = self.natives.get(text)
+        if native is not None:
+            return native.call(args)
 
-        def errorParameter(paramCount=None):
-            if paramCount is None or argCount != paramCount:
-                raise Exception(ERROR_FUNCTION_PARAMETER % text)
-
-        argCount = len(args)
-
-        if text == 'abs':
-            errorParameter(1)
-            return abs(args[0])
 
-        elif text == 'frac':
-            errorParameter(1)
-            return args[0] - int(args[0])
+class RuleSet(object):
+    """Named expressions compiled together and evaluated in one pass per record.
 
-        elif text == 'max':
-            return max(args)
-
-        elif text == 'min':
-            return min(args)
-
-        elif text == 'mod':
-            errorParameter(2);
-            return math.fmod(int(args[0]), int(args[1]))
-
-        elif text == 'round':
-            if argCount == 1:
-                return round(args[0], 2)
-            elif argCount == 2:
-                return round(args[0], int(args[1]))
-            else:
-                errorParameter()
-
-        elif text == 'sign':
-            errorParameter(1);
-            if args[0] == abs(args[0]):
-                return 1
-            elif args[0] == 0:
-                return 0
-            else:
-                return -1
+    Every rule is one expression, without assignments or _. The rules are
+    compiled as the lines of one optimized FatExpression, so a subtree
+    repeated by any rules, or a whole repeated rule, is calculated once per
+    record (see ExpOptimizer.share). The functions, variables, callbacks and
+    natives are added to the rule set like to a FatExpression. evaluate()
+    keeps no state, so threads can share a compiled rule set.
+    """
 
-        elif text == 'sqrt': # Returns the square root of X.
-            errorParameter(1)
-            return math.sqrt(args[0])
+    def __init__(self, rules=None):
+        self._owner = FatExpression()
+        self._owner.optimize = True
+        self._rules = OrderedDict()
+        self._compiled = None
+        self._plans = {}
+        if rules:
+            self.addRules(rules)
 
-        elif text == 'sin':  # Returns the sine of the angle in radians.
-            errorParameter(1)
-            return math.sin(args[0])
+    def __len__(self):
+        return len(self._rules)
 
-        elif text == 'cos':  # Calculates the cosine of an angle.
-            errorParameter(1);
-            return math.cos(args[0])
+    def __contains__(self, name):
+        return name in self._rules
 
-        elif text == 'tan':
-            errorParameter(1)
-            return math.tan(args[0])
+    def names(self):
+        return list(self._rules)
 
-        elif text == 'atan':  # Calculates the arctangent of a given number.
-            errorParameter(1)
-            return math.atan(args[0])
+    @property
+    def shared(self):
+        """Occurrences of subtrees read from another rule or occurrence (see FatExpression.shared)"""
+        self.compile()
+        return self._owner.shared
+
+    def addRules(self, rules):
+        """Adds the rules of a dict of name: expression; adds none if one is invalid"""
+        for name, text in rules.items():
+            if ';' in text or ':' in text or text.strip() == '':
+                raise Exception(ERROR_RULE_TEXT % name)
+            if any(node.opcode == opOldValue for node in expCache.get(text.strip()).walk()):
+                raise Exception(ERROR_RULE_TEXT % name)
+            if name in self._rules:
+                raise Exception(ERROR_RULE_DUPLICATE % name)
+        for name, text in rules.items():
+            self._rules[name] = text.strip()
+        self._invalidate()
+
+    def clearRules(self):
+        self._rules = OrderedDict()
+        self._invalidate()
 
-        elif text == 'log':   # Returns the natural log of a real expression.
-            errorParameter(1)
-            return math.log(args[0])
+    def addFunctions(self, functions):
+        self._owner.addFunctions(functions)
+        self._invalidate()
 
-        elif text == 'exp':   # Returns the exponential of X.
-            errorParameter(1)
-            return math.exp(args[0])
+    def addVariables(self, variables):
+        self._owner.addVariables(variables)
+        self._invalidate()
 
-        elif text == 'sum':
-            return sum(args)
+    def addEvaluate(self, evaluate, pure=False, capacity=0, ttl=None):
+        self._invalidate()
+        return self._owner.addEvaluate(evaluate, pure, capacity, ttl)
 
-        elif text == 'trunc':
-            errorParameter(1)
-            return math.trunc(args[0])
+    def addNative(self, name, function, argCount=None, pure=True, vector=None):
+        self._invalidate()
+        return self._owner.addNative(name, function, argCount, pure, vector)
 
-        elif text == 'and':
-            for b in args:
-              if not bool(b):
-                  return 0
-            return 1
+    def _invalidate(self):
+        self._compiled = None
+        self._plans = {}
 
-        elif text == 'or':
-            for b in args:
-              if bool(b):
-                  return 0
+    def compile(self):
+        """Compiles the rules, once until rules, functions, variables or callbacks change"""
+        if self._compiled is None:
+            self._owner.text = list(self._rules.values())
+            self._compiled = ExpCompiled(self._owner)
+        return self._compiled
+
+    def _plan(self, names):
+        """(name, tree) calculated for the rules names; name is None for the values
+        stored by other rules that the rules read"""
+        key = None if names is None else frozenset(names)
+        plan = self._plans.get(key)
+        if plan is not None:
+            return plan
+
+        lines = list(zip(self._rules, (tree for variable, tree in self.compile()._lines)))
+        if key is None:
+            plan = lines
+        else:
+            for name in key:
+                if name not in self._rules:
+                    raise Exception(ERROR_RULE_NAME % name)
+            stores = {}
+            for name, tree in lines:
+                for node in tree.walk():
+                    if node.opcode == opStore:
+                        stores[node.value] = node
+
+            # the stored values read by the rules, also through other stored values
+            needed = set()
+            pending = [tree for name, tree in lines if name in key]
+            while pending:
+                for node in pending.pop().walk():
+                    if node.opcode == opLocal and node.value not in needed:
+                        needed.add(node.value)
+                        pending.append(stores[node.value])
+
+            plan = []
+            for name, tree in lines:
+                if name in key:
+                    plan.append((name, tree))
+                    continue
+                stack = [tree]
+                while stack:
+                    node = stack.pop()
+                    if node.opcode == opStore and node.value in needed:
+                        plan.append((None, node))
+                    else:
+                        stack.extend(reversed(node.childRight))
+                        stack.extend(reversed(node.childLeft))
+
+        self._plans[key] = plan
+        return plan
+
+    def evaluate(self, record=None, names=None):
+        """Dict of the values of the rules (or of the rules names) for the variables of record"""
+        plan = self._plan(names)
+        context = ExpContext(self._compiled, record)
+        results = {}
+        for name, tree in plan:
+            value = tree.calculate(context)
+            if name is not None:
+                results[name] = value
+        return results
+
+
+def _recordVariables(record):
+    """The numeric fields of a CSV or JSON record, as variables"""
+    variables = {}
+    for name, value in record.items():
+        if not isinstance(name, str):
+            continue
+        if isinstance(value, str):
+            try:
+                variables[name] = float(value)
+            except ValueError:
+                pass
+        elif isinstance(value, (int, float)):
+            variables[name] = float(value)
+    return variables
+
+
+def _openStream(path, mode, bufferSize, stream):
+    """Opens path, or stream when path is -, as UTF-8 text buffered by bufferSize bytes"""
+    if path == '-':
+        return open(stream.fileno(), mode, bufferSize, 'utf-8', newline='', closefd=False)
+    return open(path, mode, bufferSize, 'utf-8', newline='')
+
+
+def main(argv=None):
+    """Command line: python -m fatexpression evaluates expressions over the records of a
+    CSV or JSON Lines stream, writing the results as new columns; one record is
+    kept in memory at a time"""
+    parser = argparse.ArgumentParser(
+        prog='python -m fatexpression',
+        description='Evaluates expressions over the records of a CSV or JSON Lines stream and '
+                    'writes the records with the results as new columns. The numeric fields are '
+                    'the variables.')
+    parser.add_argument('input', nargs='?', default='-', help='input file (default: standard input)')
+    parser.add_argument('-e', '--expression', nargs=2, action='append', required=True, metavar=('NAME', 'TEXT'),
+                        help='column and expression; lines separated by ; as in FatExpression.text')
+    parser.add_argument('-f', '--function', action='append', default=[], metavar='TEXT',
+                        help='user-defined functions, as accepted by addFunctions')
+    parser.add_argument('-v', '--variable', action='append', default=[], metavar='NAME=VALUE',
+                        help='variables of every record, as accepted by addVariables')
+    parser.add_argument('-o', '--output', default='-', help='output file (default: standard output)')
+    parser.add_argument('--format', choices=('csv', 'jsonl'),
+                        help='format of input and output (default: by the extension of input, else csv)')
+    parser.add_argument('--optimize', action='store_true', help='simplify the expressions when compiling')
+    parser.add_argument('--keep-going', action='store_true',
+                        help='write an empty result and report the error when an expression fails')
+    parser.add_argument('--buffer-size', type=int, default=1 << 20, metavar='BYTES',
+                        help='size of the read and write buffers (default: 1 MiB)')
+    args = parser.parse_args(argv)
+
+    dataFormat = args.format
+    if dataFormat is None:
+        dataFormat = 'jsonl' if os.path.splitext(args.input)[1].lower() in ('.jsonl', '.ndjson', '.json') else 'csv'
+
+    owner = FatExpression()
+    try:
+        for functions in args.function:
+            owner.addFunctions(functions)
+        for variables in args.variable:
+            owner.addVariables(variables)
+    except Exception as error:
+        sys.stderr.write('fatexpression: %s\n' % error)
+        return 1
+    owner.optimize = args.optimize
+    expressions = []
+    for name, text in args.expression:
+        owner.text = text
+        try:
+            expressions.append((name, owner.compileExpression()))
+        except Exception as error:
+            sys.stderr.write('fatexpression: %s: %s\n' % (name, error))
             return 1
 
-        elif text == 'if':
-            errorParameter(3)
-            if bool(args[0]):
-                return args[1]
-            else:
-                return args[2]
+    try:
+        source = _openStream(args.input, 'r', args.buffer_size, sys.stdin)
+        try:
+            target = _openStream(args.output, 'w', args.buffer_size, sys.stdout)
+        except OSError:
+            source.close()
+            raise
+    except OSError as error:
+        sys.stderr.write('fatexpression: %s\n' % error)
+        return 1
+
+    with source, target:
+        if dataFormat == 'csv':
+            records = csv.DictReader(source)
+            fields = list(records.fieldnames or ())
+            writer = csv.DictWriter(target, fields + [name for name, compiled in expressions if name not in fields],
+                                    restval='', extrasaction='ignore')
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            records = (json.loads(line) for line in source if line.strip())
+            write = lambda record: target.write(json.dumps(record) + '\n')
 
-        elif text == 'random':
-            errorParameter(0);
-            return random.random()
+        for number, record in enumerate(records, 1):
+            if not isinstance(record, dict):
+                sys.stderr.write('fatexpression: record %d is not an object\n' % number)
+                return 1
+            variables = _recordVariables(record)
+            for name, compiled in expressions:
+                try:
+                    value = compiled.evaluate(variables)
+                except Exception as error:
+                    sys.stderr.write('fatexpression: record %d, %s: %s\n' % (number, name, error))
+                    if not args.keep_going:
+                        return 1
+                    value = '' if dataFormat == 'csv' else None
+                record[name] = value
+            write(record)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
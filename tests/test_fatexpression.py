@@ -4,9 +4,24 @@
 Classe de testes da classe FatExpression
 """
 
+import asyncio
+import copy
+import io
+import json
+import math
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
 import fatexpression
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def processo(text, args):
     if text == 'b':
         return 23
@@ -83,5 +98,1096 @@ class TestFatExpression(unittest.TestCase):
     def test20(self):
         self.assertEqual(self.start('log(1)'), 0)
 
+    def test21(self):
+        self.assertEqual(self.start('x:0;x+1'), 1)
+
+
+class ComparedModes(object):
+    """Runs the TestFatExpression cases with the settings of a mode, checking that
+    every value equals the one of the tree walker"""
+
+    settings = {}
+
+    def start(self, text):
+        self.exp.text = text
+        expected = self.exp.value
+        for name, value in self.settings.items():
+            setattr(self.exp, name, value)
+        self.exp._value_old = None
+        result = self.exp.value
+        self.assertEqual(result, expected)
+        self.assertEqual(type(result), type(expected))
+        return result
+
+
+class TestTokenize(unittest.TestCase):
+
+    def tokens(self, text):
+        return [(token.tokenText, token.tokenType) for token in fatexpression.tokenize(text)]
+
+    def test_types(self):
+        self.assertEqual(self.tokens(' x1(2.5, _) >= ~a '), [
+            ('x1', fatexpression.ttString), ('(', fatexpression.ttParenthesisOpen),
+            ('2.5', fatexpression.ttNumeric), (',', fatexpression.ttParamDelimitor),
+            ('_', fatexpression.ttOldValue), (')', fatexpression.ttParenthesisClose),
+            ('>=', fatexpression.ttRelation), ('~', fatexpression.ttOperation),
+            ('a', fatexpression.ttString)])
+
+    def test_stream(self):
+        tokens = fatexpression.tokenize('1+$')
+        self.assertEqual(next(tokens).tokenText, '1')
+        self.assertEqual(next(tokens).tokenText, '+')
+        self.assertRaises(Exception, next, tokens)
+
+    def test_brackets(self):
+        for text in ['(1]', '1)', '{1', '[(1])']:
+            self.assertRaises(Exception, self.tokens, text)
+
+    def test_read_tokens(self):
+        parser = fatexpression.ExpParser('a<>b|c')
+        token = parser.readFirstToken()
+        while token:
+            token = parser.readNextToken()
+        self.assertEqual([token.tokenText for token in parser.tokens], ['a', '<>', 'b', '|', 'c'])
+
+
+class TestBuild(unittest.TestCase):
+
+    def shape(self, node):
+        if not node.childLeft and not node.childRight:
+            return node.text
+        return (node.text,) + tuple(self.shape(child) for child in node.childLeft + node.childRight)
+
+    def build(self, text):
+        return self.shape(fatexpression.buildTree(text))
+
+    def test_priorities(self):
+        self.assertEqual(self.build('1+2*3^2'), ('+', '1', ('*', '2', ('^', '3', '2'))))
+        self.assertEqual(self.build('a/b/c'), ('/', ('/', 'a', 'b'), 'c'))
+        self.assertEqual(self.build('-a-b'), ('-', ('-', 'a'), 'b'))
+        self.assertEqual(self.build('~a<b&c|d'), ('&', ('<', ('~', 'a'), 'b'), ('|', 'c', 'd')))
+        self.assertEqual(self.build('2^3!*2'), ('*', ('^', '2', ('!', '3')), '2'))
+
+    def test_functions(self):
+        self.assertEqual(self.build('f()+g(a,(b),h(1))'), ('+', 'f', ('g', 'a', 'b', ('h', '1'))))
+        self.assertEqual(self.build('{[(x)]}'), 'x')
+
+    def test_nodes(self):
+        tree = fatexpression.buildTree('(-1.5)+F(2)<_')
+        self.assertEqual(tree.opcode, fatexpression.opLess)
+        self.assertEqual(tree.childRight[0].opcode, fatexpression.opOldValue)
+        node = tree.childLeft[0]
+        self.assertEqual(node.opcode, fatexpression.opAdd)
+        self.assertEqual(node.childLeft[0].opcode, fatexpression.opNegate)
+        self.assertEqual(node.childLeft[0].childRight[0].value, 1.5)
+        self.assertEqual(node.childRight[0].value, 'f')
+        self.assertFalse(hasattr(node, '__dict__'))
+        self.assertFalse(hasattr(node, 'parent'))
+
+    def test_errors(self):
+        for text in ['1+', '(1)(2)', 'a b', '1,2', 'f(1;2)', '!1', 'a~b', '*1']:
+            self.assertRaises(Exception, fatexpression.buildTree, text)
+
+
+class TestCompiled(unittest.TestCase):
+
+    def setUp(self):
+        self.exp = fatexpression.FatExpression()
+        self.exp.addVariables({'c':30})
+        self.exp.text = 'a:c*2;a+1'
+
+    def test_reuse(self):
+        self.assertEqual(self.exp.value, 61)
+        program = self.exp._program
+        self.assertTrue(self.exp.compiled)
+        self.exp.addVariables({'c':5})
+        self.assertEqual(self.exp.value, 11)
+        self.assertTrue(self.exp._program is program)
+
+    def test_text_change(self):
+        self.assertEqual(self.exp.value, 61)
+        self.exp.text = 'c-1'
+        self.assertFalse(self.exp.compiled)
+        self.assertEqual(self.exp.value, 29)
+
+    def test_locals(self):
+        self.exp.value
+        self.exp.text = 'a'
+        self.assertRaises(Exception, lambda: self.exp.value)
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = fatexpression.ExpCache(2)
+
+    def test_shared(self):
+        fatexpression.expCache.clear()
+        a = fatexpression.FatExpression()
+        b = fatexpression.FatExpression()
+        a.text = b.text = '1+2*3'
+        self.assertEqual(a.value, 7)
+        self.assertEqual(b.value, 7)
+        self.assertTrue(a._program[0][1] is b._program[0][1])
+        self.assertEqual(fatexpression.expCache.hits, 1)
+        self.assertEqual(fatexpression.expCache.misses, 1)
+
+    def test_lru(self):
+        a = self.cache.get('1+1')
+        self.cache.get('2+2')
+        self.assertTrue(self.cache.get('1+1') is a)
+        self.cache.get('3+3')
+        self.assertFalse('2+2' in self.cache)
+        self.assertTrue('1+1' in self.cache)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_capacity(self):
+        self.cache.get('1+1')
+        self.cache.get('2+2')
+        self.cache.capacity = 1
+        self.assertEqual(len(self.cache), 1)
+        self.cache.capacity = 0
+        self.cache.get('1+1')
+        self.assertEqual(len(self.cache), 0)
+        self.cache.clear()
+        self.assertEqual(self.cache.stats()['misses'], 0)
+
+
+class TestFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.exp = fatexpression.FatExpression()
+        self.exp.addFunctions('x(a,b)=a*b;X2(a)=a;y(a)=x(a,x2(a))+1')
+
+    def test_registry(self):
+        self.assertEqual(sorted(self.exp.functions), ['x', 'x2', 'y'])
+        self.assertTrue(self.exp.findFunction('X2') is self.exp.functions['x2'])
+        self.exp.text = 'y(3)'
+        self.assertEqual(self.exp.value, 10)
+
+    def test_duplicate(self):
+        self.assertRaises(Exception, self.exp.addFunctions, ['x(c)=c'])
+        self.assertRaises(Exception, fatexpression.FatExpression().addFunctions, 'f(a)=a;F(b)=b')
+
+    def test_cyclic(self):
+        self.assertRaises(Exception, self.exp.addFunctions, 'f(a)=g(a);g(a)=h(a)+1;h(a)=f(a)')
+        self.assertRaises(Exception, self.exp.addFunctions, ['r(a)=r(a-1)'])
+        self.assertEqual(sorted(self.exp.functions), ['x', 'x2', 'y'])
+
+    def test_argument_shadows_function(self):
+        self.exp.addFunctions(['z(x)=x*2'])
+        self.exp.text = 'z(4)'
+        self.assertEqual(self.exp.value, 8)
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.exp = fatexpression.FatExpression()
+        self.exp.addVariables({'c':10})
+        self.exp.addFunctions(['x(a,b)=a*b'])
+        self.exp.text = 't:x(a,b);t+c'
+
+    def test_rows(self):
+        result = self.exp.evaluateMany([{'a':1, 'b':2}, {'A':3, 'b':4, 'c':0}])
+        self.assertEqual(result.typecode, 'd')
+        self.assertEqual(list(result), [12, 12])
+        self.assertEqual(self.exp.expParser.findVariable('c'), 10)
+
+    def test_columns(self):
+        result = self.exp.evaluateMany({'a':[1, 2, 3], 'b':[1, 1, 2]}, typecode=None)
+        self.assertEqual(result, [11, 12, 16])
+        self.assertRaises(Exception, self.exp.evaluateMany, {'a':[1, 2], 'b':[1]})
+
+    def test_chunks(self):
+        rows = ({'a':i, 'b':2} for i in range(5))
+        chunks = list(self.exp.evaluateChunks(rows, chunkSize=2))
+        self.assertEqual([list(chunk) for chunk in chunks], [[10, 12], [14, 16], [18]])
+        self.assertEqual(list(self.exp.evaluateMany(iter([]))), [])
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestVector(unittest.TestCase):
+
+    expressions = [
+        '{2*3+[(10+2)/(5+1)]+2}', 'x(x(c,x2(a)),x2(3))', '(-a)*3+b^2-a%3', 'a!',
+        'if(a>b, a, b)+if(a<=b, 1, 0)+(a>=2)+(a<>b)+(a=b)', '~(a<b)|(a=1)&1?(b>2)',
+        'max(a,b,c)-min(a,b)+sum(a,b)+abs(-a)+sign(a-b)+trunc(b/3)+frac(b/3)',
+        'and(a,b-1)+or(a-1,0)+mod(b,3)+round(b/3)+round(b/3,1)+sqrt(a)+log(a)+exp(b/10)',
+        'sin(a)+cos(b)+tan(a)+atan(b)', 't:a*2;_+t+y(a)',
+    ]
+
+    def setUp(self):
+        self.exp = fatexpression.FatExpression()
+        self.exp.addEvaluate(processo)
+        self.exp.addEvaluate(lambda text, args: args[0] * 10 if text == 'y' else None)
+        self.exp.addVariables({'c':30})
+        self.exp.addFunctions(['x(a,b)=a*b', 'x2(a)=a'])
+        self.columns = {'a':[1, 2, 3, 4, 5], 'B':[5, 4, 3, 2, 1]}
+
+    def test_equivalence(self):
+        for text in self.expressions:
+            self.exp.text = text
+            expected = list(self.exp.evaluateMany(self.columns))
+            result = self.exp.evaluateArrays(self.columns)
+            self.assertEqual(result.shape, (5,))
+            for a, b in zip(result, expected):
+                self.assertAlmostEqual(a, b, msg=text)
+
+    def test_constant(self):
+        self.exp.text = '1+2'
+        self.assertEqual(list(self.exp.evaluateArrays(self.columns)), [3] * 5)
+
+    def test_event_first(self):
+        self.exp.evaluateOrder = fatexpression.eoEventFirst
+        self.exp.text = 'a+c'
+        self.assertEqual(list(self.exp.evaluateArrays({'a':[1, 2]})), [31, 32])
+
+    def test_errors(self):
+        self.exp.text = 'x(a)'
+        self.assertRaises(Exception, self.exp.evaluateArrays, self.columns)
+        self.exp.text = 'z+a'
+        self.assertRaises(Exception, self.exp.evaluateArrays, self.columns)
+
+
+class TestCodeGen(ComparedModes, TestFatExpression):
+    """Runs the TestFatExpression cases with generated code"""
+
+    settings = {'evaluateMode': fatexpression.emCode}
+
+    def test_function(self):
+        self.exp.text = 't:x(a,c);if(t>b, t, b)+x2(d)'
+        function = self.exp.compileFunction()
+        self.assertEqual(function.variables, ['a', 'c', 'b', 'd'])
+        self.assertEqual(function(a=2, b=100, c=1, d=3), 103)
+        self.assertEqual(function(2, 1, 100, 3), 103)
+        self.assertEqual(function(a=2), 80)
+        self.assertRaises(Exception, function)
+
+    def test_event_first(self):
+        self.exp.evaluateOrder = fatexpression.eoEventFirst
+        self.exp.text = 'b:1;b+c'
+        self.assertEqual(self.exp.compileFunction()(), 53)
+
+    def test_invalidate(self):
+        self.exp.evaluateMode = fatexpression.emCode
+        self.exp.text = 'y(2)'
+        self.exp.addFunctions(['y(a)=a+1'])
+        self.assertEqual(self.exp.value, 3)
+        self.exp.clearFunctions()
+        self.exp.addFunctions(['y(a)=a+2'])
+        self.assertEqual(self.exp.value, 4)
+
+    def test_variable_native(self):
+        self.exp.addVariables({'max': 2, 'round': 2})
+        self.assertEqual(self.start('max+1'), 3)
+        self.assertEqual(self.start('round+1'), 3)
+        self.assertEqual(self.start('max(4,5)'), 5)
+
+    def test_variable_builtin(self):
+        self.exp.addVariables({'float': 2, 'int': 7})
+        self.assertEqual(self.start('float+1'), 3)
+        self.assertEqual(self.start('int%float'), 1)
+
+    def test_injection(self):
+        stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            self.assertEqual(self.start('q = print("injected") or 0\n    _l_q:1;2'), 2)
+            self.assertEqual(sys.stdout.getvalue(), '')
+        finally:
+            sys.stdout = stdout
+        self.assertFalse('injected' in self.exp.compileFunction().source)
+
+    def test_names(self):
+        self.exp.addVariables({'a.b': 2, 'x1': 3})
+        self.exp.addFunctions(['f.g(a)=a*10'])
+        self.assertEqual(self.start('a.b+x1'), 5)
+        self.assertEqual(self.start('f.g(2)+1'), 21)
+        self.assertEqual(self.start('y.z:2;y.z+1'), 3)
+        self.assertEqual(self.start('my var:2;3'), 3)
+        self.assertEqual(self.exp.compileFunction()(**{'a.b': 4}), 3)
+
+
+class TestProgram(ComparedModes, TestFatExpression):
+    """Runs the TestFatExpression cases with stack-machine programs"""
+
+    settings = {'evaluateMode': fatexpression.emProgram}
+
+    def test_program(self):
+        self.exp.text = 't:x(a,c)+2;if(t>b, t, b)+x2(d)*2'
+        program = self.exp.compileProgram()
+        self.assertEqual(len(program.constants), 1)
+        self.assertEqual(len(program.functions), 2)
+        self.assertEqual(program, self.exp.compileProgram())
+        self.assertEqual(hash(program), hash(self.exp.compileProgram()))
+        self.assertEqual(pickle.loads(pickle.dumps(program)), program)
+        self.assertEqual(copy.deepcopy(program), program)
+        self.exp.text = 't:x(a,c)+2;if(t>b, t, b)+x2(d)*3'
+        self.assertNotEqual(self.exp.compileProgram(), program)
+
+    def test_udf(self):
+        self.exp.evaluateMode = fatexpression.emProgram
+        self.exp.addFunctions(['y(a)=a+z(a)', 'z(b)=b*c'])
+        self.exp.text = 'c:2;y(3)'
+        self.assertEqual(self.exp.value, 9)
+        self.exp.text = 'y(3,4)'
+        self.assertRaises(Exception, getattr, self.exp, 'value')
+
+    def test_event_first(self):
+        self.exp.evaluateMode = fatexpression.emProgram
+        self.exp.evaluateOrder = fatexpression.eoEventFirst
+        self.exp.text = 'b:1;b+c'
+        self.assertEqual(self.exp.value, 53)
+
+
+class TestOptimize(ComparedModes, TestFatExpression):
+    """Runs the TestFatExpression cases with simplified syntax trees"""
+
+    settings = {'optimize': True}
+
+    def shape(self, text):
+        self.exp.optimize = True
+        self.exp.text = text
+        self.exp.compile()
+        node = self.exp._program[-1][1]
+        def show(node):
+            args = [show(child) for child in node.childLeft + node.childRight]
+            return node.text + ('(%s)' % ','.join(args) if args else '')
+        return show(node)
+
+    def test_fold(self):
+        self.assertEqual(self.shape('{2*3+[(10+2)/(5+1)]+2}*a'), '*(10.0,a)')
+        self.assertEqual(self.exp.eliminated, 12)
+        self.assertEqual(self.shape('sqrt(4)+max(1,2)+b'), '+(4.0,b)')
+        self.assertEqual(self.shape('random()*2'), '*(random,2)')
+        self.assertEqual(self.shape('(1>2)|b'), '|(false,b)')
+        self.assertEqual(self.shape('(1/0)+b'), '+(/(1,0),b)')
+
+    def test_identities(self):
+        self.assertEqual(self.shape('(a+b)*1-0'), '+(a,b)')
+        self.assertEqual(self.shape('a*1'), '*(a,1)')
+        self.assertEqual(self.shape('--a'), 'a')
+        self.assertEqual(self.shape('~~(a>b)'), '>(a,b)')
+        self.assertEqual(self.shape('~~a'), '~(~(a))')
+        self.assertEqual(self.shape('if(2>1, a, b)'), 'a')
+        self.assertEqual(self.exp.eliminated, 5)
+
+    def test_shadowing(self):
+        self.exp.addFunctions(['sqrt(x)=x'])
+        self.assertEqual(self.shape('sqrt(4)'), 'sqrt(4)')
+        self.assertEqual(self.exp.value, 4)
+        self.exp.clearFunctions()
+        self.assertEqual(self.exp.value, 2)
+        self.exp.addVariables({'max': 7})
+        self.assertEqual(self.shape('max(1,2)'), 'max(1,2)')
+        self.exp.evaluateOrder = fatexpression.eoEventFirst
+        self.assertEqual(self.shape('abs(1)'), 'abs(1)')
+
+    def test_shadowing_added(self):
+        for variables in ({'Max': 7}, ['Max=7'], 'c=1;Max=7'):
+            exp = fatexpression.FatExpression()
+            exp.optimize = True
+            exp.text = 'max(1,2)'
+            self.assertEqual(exp.value, 2)
+            exp.addVariables(variables)
+            self.assertEqual(exp.value, 7)
+
+    def test_share(self):
+        self.exp.addFunctions(['hyp(x,y)=sqrt(x^2+y^2)'])
+        text = 'h:sqrt(c^2+d^2)+hyp(c,d);k:sqrt(c^2+d^2)*hyp(c,d)+c^2;h+k'
+        self.assertEqual(self.shape(text), '+(h,k)')
+        self.assertEqual(self.exp.shared, 3)
+        for mode in (fatexpression.emTree, fatexpression.emCode, fatexpression.emProgram):
+            self.exp.evaluateMode = mode
+            self.assertAlmostEqual(self.exp.value, 2200 + 2*math.sqrt(1300), 9)
+        self.exp.text = 'sqrt(a^2+d^2)+sqrt(a^2+d^2)'
+        self.exp.compile()
+        self.assertEqual(self.exp.shared, 0)
+
+    def test_share_scope(self):
+        self.assertEqual(self.shape('random()*2+random()*2'), '+(*(random,2),*(random,2))')
+        self.assertEqual(self.shape('a:c+1;a:(c+1)*a;(c+1)*a'), '*(_cse0,a)')
+        self.assertEqual(self.exp.shared, 2)
+        self.assertEqual(self.shape('(_+1)*2;(_+1)*2'), '*(+(_,1),2)')
+        self.assertEqual(self.exp.shared, 0)
+
+    def test_share_callbacks(self):
+        calls = []
+        def price(text, args):
+            if text == 'price':
+                calls.append(args)
+                return args[0] * 10
+        self.exp.addEvaluate(price)
+        self.assertEqual(self.shape('price(2)+price(2)'), '+(price(2),price(2))')
+        self.exp.clearEvaluate()
+        self.exp.addEvaluate(self.exp.evaluateCustom)
+        self.exp.addEvaluate(price, pure=True)
+        self.assertEqual(self.shape('price(2)+price(2)'), '+(_cse0(price(2)),_cse0)')
+        self.assertEqual(self.exp.value, 40)
+        self.assertEqual(calls, [[2.0]])
+
+
+class TestInline(ComparedModes, TestFatExpression):
+    """Runs the TestFatExpression cases with the user-defined functions inlined"""
+
+    settings = {'optimize': True, 'inlineLimit': 32}
+
+    def shape(self, text):
+        if not self.exp.inlineLimit:
+            self.exp.inlineLimit = 32
+        return TestOptimize.shape(self, text)
+
+    def test_nested(self):
+        self.assertEqual(self.shape('x(x(c,x2(4)),x2(3))'), '*(*(c,4),3)')
+        self.assertEqual(self.exp.inlined, 4)
+        self.assertEqual(self.exp.value, 360)
+
+    def test_temporaries(self):
+        self.exp.addFunctions(['sq(a)=a*a', 'pick(a,b)=if(a>0, b, 0)', 'first(a,b)=a'])
+        self.assertEqual(self.shape('sq(c+1)'), '*(_inl0(+(c,1)),_inl0)')
+        for mode in (fatexpression.emTree, fatexpression.emCode, fatexpression.emProgram):
+            self.exp.evaluateMode = mode
+            self.assertEqual(self.exp.value, 961)
+        self.assertEqual(self.shape('if(c>0, sq(c+1), 0)'), 'if(>(c,0),sq(+(c,1)),0)')
+        self.assertEqual(self.shape('pick(c, d+1)'), 'pick(c,+(d,1))')
+        self.assertEqual(self.shape('first(1, random())+first(d, 2)+first(b, 2)'),
+                         '+(+(first(1,random),d),first(b,2))')
+
+    def test_limit(self):
+        self.exp.inlineLimit = 2
+        self.assertEqual(self.shape('x(c,2)+x2(d)'), '+(x(c,2),d)')
+        self.exp.addVariables({'x2': 5})
+        self.assertFalse(self.exp.compiled)
+        self.assertEqual(self.exp.value, 65)
+
+
+class TestIncremental(ComparedModes, TestFatExpression):
+    """Runs the TestFatExpression cases recalculating only changed lines"""
+
+    settings = {'incremental': True}
+
+    def setUp(self):
+        TestFatExpression.setUp(self)
+        self.exp.addVariables({'p': 2, 'q': 3})
+
+    def recalculated(self, variables=None):
+        if variables:
+            self.exp.addVariables(variables)
+        value = self.exp.value
+        return value, self.exp._graph.recalculated
+
+    def test_modes(self):
+        self.exp.text = 'p+q'
+        self.exp.incremental = True
+        for mode in (fatexpression.emCode, fatexpression.emProgram):
+            self.exp.evaluateMode = mode
+            self.assertRaises(Exception, getattr, self.exp, 'value')
+        self.exp.evaluateMode = fatexpression.emTree
+        self.assertEqual(self.exp.value, 5)
+
+    def test_update(self):
+        self.exp.incremental = True
+        self.exp.text = 'a:p*2;b:q+1;e:a+x2(c);f:b*b;a+f'
+        self.assertEqual(self.recalculated(), (20, 5))
+        self.assertEqual(self.recalculated(), (20, 0))
+        self.assertEqual(self.recalculated({'q': 4}), (29, 3))
+        self.assertEqual(self.recalculated({'q': 4}), (29, 0))
+        self.assertEqual(self.recalculated({'c': 1}), (29, 1))
+        self.assertEqual(self.recalculated({'p': 3}), (31, 3))
+
+    def test_unchanged_line(self):
+        self.exp.incremental = True
+        self.exp.text = 'a:p>1;a*q;c+_'
+        self.assertEqual(self.recalculated(), (33, 3))
+        self.assertEqual(self.recalculated({'p': 5}), (33, 1))
+
+    def test_volatile(self):
+        self.exp.incremental = True
+        self.exp.text = 'a:b+p;random()*0+q;p*q'
+        self.assertEqual(self.recalculated(), (6, 3))
+        self.assertEqual(self.recalculated(), (6, 2))
+        self.exp.text = '_+1;p'
+        self.assertEqual(self.recalculated(), (2, 2))
+        self.assertEqual(self.recalculated(), (2, 1))
+
+    def test_error(self):
+        self.exp.incremental = True
+        self.exp.text = 'a:p*2;z+a'
+        self.assertRaises(Exception, getattr, self.exp, 'value')
+        self.assertEqual(self.recalculated({'z': 1}), (5, 2))
+        self.assertEqual(self.recalculated(), (5, 0))
+
+
+class TestNatives(unittest.TestCase):
+
+    def setUp(self):
+        self.exp = fatexpression.FatExpression()
+        self.exp.addVariables({'p': 2, 'q': 12})
+        self.exp.addNative('clamp', lambda x, low, high: min(max(x, low), high), 3,
+                           vector=lambda x, low, high: numpy.clip(x, low, high))
+        self.exp.addNative('lerp', lambda a, b, t: a + (b - a) * t, 3)
+        self.exp.addNative('log10', math.log10, 1)
+
+    def check(self, text, value):
+        for mode in (fatexpression.emTree, fatexpression.emCode, fatexpression.emProgram):
+            self.exp.evaluateMode = mode
+            self.exp.text = text
+            self.assertEqual(self.exp.value, value)
+
+    def test_call(self):
+        self.check('clamp(q, 0, 10)+lerp(0, 10, 0.5)+log10(100)', 17)
+        self.check('sqrt(4)+max(p,3)+round(1.234)+round(1.5,0)', 8.23)
+        self.exp.text = 'clamp(q, 0, 10)'
+        self.assertEqual(self.exp.evaluateMany({'q': [-1, 5, 20]}).tolist(), [0, 5, 10])
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_vector(self):
+        self.exp.text = 'clamp(q, 0, 10)+lerp(0, 10, p)'
+        result = self.exp.evaluateArrays({'q': [-1, 5, 20], 'p': [0, 0.5, 1]})
+        self.assertEqual(result.tolist(), [0, 10, 20])
+
+    def test_parameters(self):
+        for mode in (fatexpression.emTree, fatexpression.emCode, fatexpression.emProgram):
+            self.exp.evaluateMode = mode
+            self.exp.text = 'clamp(q, 0)'
+            self.assertRaises(Exception, getattr, self.exp, 'value')
+
+    def test_impure(self):
+        values = iter([1, 2, 3])
+        self.exp.addNative('tick', lambda: next(values), 0, pure=False)
+        self.exp.optimize = True
+        self.exp.text = 'tick()*10+tick()*10'
+        self.assertEqual(self.exp.value, 30)
+        self.assertEqual(self.exp.shared, 0)
+
+    def test_registry(self):
+        self.assertNotIn('clamp', fatexpression.nativeFunctions)
+        fatexpression.registerNative('twice', lambda x: x * 2, 1)
+        try:
+            exp = fatexpression.FatExpression()
+            exp.text = 'twice(4)'
+            self.assertEqual(exp.value, 8)
+        finally:
+            del fatexpression.nativeFunctions['twice']
+        self.exp.text = 'twice(4)'
+        self.assertRaises(Exception, getattr, self.exp, 'value')
+
+
+class TestResolve(unittest.TestCase):
+
+    def setUp(self):
+        self.exp = fatexpression.FatExpression()
+        self.exp.addEvaluate(processo)
+        self.exp.addVariables({'c': 30})
+        self.exp.addFunctions(['x(a,b)=a*b+c'])
+
+    def opcodes(self, tree):
+        return [node.opcode for node in tree.walk() if node.opcode not in (fatexpression.opNumeric,
+                fatexpression.opAdd, fatexpression.opMultiply)]
+
+    def test_kinds(self):
+        self.exp.text = 'e:c+b;x(e,2)+sqrt(4)+e+z'
+        self.exp.compile()
+        self.assertEqual(self.opcodes(self.exp._resolved[0][1]),
+                         [fatexpression.opVariable, fatexpression.opCall])
+        self.assertEqual(self.opcodes(self.exp._resolved[1][1]),
+                         [fatexpression.opCallFunction, fatexpression.opLocal, fatexpression.opCallNative,
+                          fatexpression.opLocal, fatexpression.opCall])
+        self.assertEqual(self.opcodes(self.exp.functions['x'].body),
+                         [fatexpression.opArgument, fatexpression.opArgument, fatexpression.opVariable])
+        self.exp.addVariables({'z': 1})
+        self.assertEqual(self.exp.value, 192)
+
+    def test_shadowing(self):
+        self.exp.text = 'c:2;x(1,1)'
+        self.assertEqual(self.exp.value, 3)
+        self.exp.text = 'sqrt(4)+x(1,1)'
+        self.assertEqual(self.exp.value, 33)
+        self.exp.addVariables({'sqrt': 5})
+        self.assertEqual(self.exp.value, 36)
+        self.exp.clearVariables()
+        self.assertEqual(self.exp.evaluateMany({'c': [1, 2]}).tolist(), [4, 5])
+
+    def test_event_first(self):
+        self.exp.evaluateOrder = fatexpression.eoEventFirst
+        self.exp.text = 'b:1;b+x(1,1)'
+        self.assertEqual(self.exp.value, 54)
+        self.assertEqual(self.opcodes(self.exp.functions['x'].body),
+                         [fatexpression.opArgument, fatexpression.opArgument, fatexpression.opIdentifier])
+
+
+class TestLazy(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.exp = fatexpression.FatExpression()
+        self.exp.addEvaluate(self.cost, pure=True)
+        self.exp.addVariables({'p': 2})
+        self.exp.addFunctions(['guard(x)=if(x>0, cost(x), 0)'])
+
+    def cost(self, text, args):
+        if text == 'cost':
+            self.calls.append(args[0])
+            return args[0] * 10
+
+    def check(self, text, value, calls):
+        for mode in (fatexpression.emTree, fatexpression.emCode, fatexpression.emProgram):
+            self.exp.evaluateMode = mode
+            self.exp.text = text
+            del self.calls[:]
+            self.assertEqual(self.exp.value, value)
+            self.assertEqual(self.calls, calls)
+
+    def test_if(self):
+        self.check('if(p>1, cost(1), cost(2))', 10, [1])
+        self.check('if(p<1, cost(1), cost(2))', 20, [2])
+        self.check('guard(p-3)+guard(p)', 20, [2])
+
+    def test_and_or(self):
+        self.check('and(p<1, cost(1))', 0, [])
+        self.check('and(p>1, cost(1), 0, cost(2))', 0, [1])
+        self.check('or(p>1, cost(1))', 1, [])
+        self.check('or(0, cost(1))', 1, [1])
+
+    def test_operators(self):
+        self.check('(p<1) & (cost(1)>0)', 0, [])
+        self.check('(p>1) | (cost(1)>0)', 1, [])
+        self.check('(p>1) & (cost(1)>0)', 1, [1])
+
+    def test_event_first(self):
+        self.exp.evaluateOrder = fatexpression.eoEventFirst
+        self.check('if(p>1, cost(1), cost(2))', 10, [1])
+
+    def test_shared(self):
+        self.exp.optimize = True
+        self.check('if(p<1, sqrt(cost(4)), 0) + sqrt(cost(4)) + sqrt(cost(4))', 2 * math.sqrt(40), [4])
+        self.check('sqrt(cost(4)) + if(p>1, sqrt(cost(4)), 0)', 2 * math.sqrt(40), [4])
+
+    def test_parameters(self):
+        self.exp.text = 'if(p, 1)'
+        self.assertRaises(Exception, getattr, self.exp, 'value')
+
+
+class TestThreads(unittest.TestCase):
+
+    def setUp(self):
+        self.exp = fatexpression.FatExpression()
+        self.exp.addVariables({'c':30})
+        self.exp.addFunctions(['f(a)=a*k+c'])
+        self.exp.text = 'k:x*2;f(k)+_'
+
+    def test_evaluate(self):
+        compiled = self.exp.compileExpression()
+        self.assertEqual(compiled.evaluate({'x':1}), 36)
+        self.assertEqual(compiled.evaluate('x=2;c=1'), 21)
+        self.assertEqual(compiled.evaluate({'x':1}), 36)
+        self.assertEqual(compiled.variables['c'], 30)
+
+    def test_snapshot(self):
+        compiled = self.exp.compileExpression()
+        self.exp.clearFunctions()
+        self.exp.addFunctions(['f(a)=0'])
+        self.exp.addVariables({'c':0})
+        self.assertEqual(compiled.evaluate({'x':1}), 36)
+        self.assertRaises(Exception, setattr, compiled, 'text', 'x')
+
+    def test_optimize(self):
+        self.exp.optimize = True
+        self.exp.text = 'sqrt(x*x)+sqrt(x*x)+y'
+        self.exp.addEvaluate(lambda text, args: 5 if text == 'y' else None)
+        self.assertEqual(self.exp.compileExpression().evaluate({'x':3}), 11)
+
+    def test_threaded(self):
+        other = fatexpression.FatExpression()
+        other.text = 'if(x>1, x, -x)'
+        jobs = [(self.exp if i % 2 else other, {'x':i}) for i in range(100)]
+        expected = [4 * i * i + 30 + 2 * i if i % 2 else (i if i > 1 else -i) for i in range(100)]
+        self.assertEqual(fatexpression.evaluateThreaded(jobs, 4), expected)
+        self.assertEqual(fatexpression.evaluateThreaded([]), [])
+
+    def test_pickle(self):
+        self.exp.optimize = True
+        self.exp.addEvaluate(processo, pure=True)
+        self.exp.text = 'k:x*2;f(k)+_+b'
+        compiled = pickle.loads(pickle.dumps(self.exp.compileExpression()))
+        self.assertEqual(compiled.evaluate({'x':1}), 59)
+        self.assertEqual(compiled.functions['f'].text, 'f(a)=a*k+c')
+
+    def test_processes(self):
+        rows = {'x': list(range(50))}
+        expected = self.exp.compileExpression().evaluateMany(rows)
+        self.assertEqual(list(expected), [4 * i * i + 30 + 2 * i for i in range(50)])
+        self.assertEqual(self.exp.evaluateParallel(rows, chunkSize=7, maxWorkers=2), expected)
+        rows = [{'x':i} for i in range(10)]
+        self.assertEqual(fatexpression.evaluateProcesses(self.exp, rows, maxWorkers=2, typecode=None),
+                         list(expected[:10]))
+        rows = [{' X ': '3'}, {'x': 1}]
+        expected = self.exp.evaluateMany(rows)
+        self.assertEqual(list(expected), [72, 36])
+        self.assertEqual(self.exp.compileExpression().evaluateMany(rows), expected)
+        self.assertEqual(self.exp.evaluateParallel(rows, maxWorkers=2), expected)
+
+
+class TestAsync(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.running = 0
+        self.peak = 0
+        self.exp = fatexpression.FatExpression()
+        self.exp.addVariables({'c':2})
+        self.exp.addEvaluate(self.rate)
+
+    async def rate(self, text, args):
+        if text != 'rate':
+            return None
+        self.calls.append(args[0])
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        return args[0] * 10
+
+    def check(self, text, expected, calls, peak, limit=None, order=fatexpression.eoInternalFirst):
+        self.exp.text = text
+        self.exp.evaluateOrder = order
+        self.assertEqual(asyncio.run(self.exp.evaluateAsync(limit=limit)), expected)
+        self.assertEqual(sorted(self.calls), calls)
+        self.assertEqual(self.peak, peak)
+
+    def test_gather(self):
+        text = '+'.join('rate(%d)' % i for i in range(12))
+        self.check(text, 660, list(range(12)), 12)
+
+    def test_limit(self):
+        self.check('rate(1)+rate(c)+rate(3)+rate(c*2)', 100, [1, 2, 3, 4], 2, limit=2)
+
+    def test_dependent(self):
+        self.check('a:rate(1);rate(a)+rate(c)', 120, [1, 2, 10], 2)
+
+    def test_lazy(self):
+        self.check('if(c>1, rate(1), rate(2))+rate(3)', 40, [1, 3], 1)
+
+    def test_event_first(self):
+        self.exp.addFunctions(['f(a)=rate(a)'])
+        self.check('f(c)+rate(c)', 40, [2, 2], 1, order=fatexpression.eoEventFirst)
+
+    def test_repeated(self):
+        ticks = []
+        def tick(text, args):
+            if text == 'tick':
+                ticks.append(args[0])
+                return len(ticks)
+        exp = fatexpression.FatExpression()
+        exp.addEvaluate(tick)
+        exp.text = 'tick(1)+tick(1)'
+        self.assertEqual(exp.value, 3)
+        del ticks[:]
+        self.assertEqual(asyncio.run(exp.evaluateAsync()), 3)
+        self.assertEqual(ticks, [1, 1])
+        exp.clearEvaluate()
+        exp.addEvaluate(tick, pure=True)
+        del ticks[:]
+        self.assertEqual(asyncio.run(exp.evaluateAsync()), 2)
+        self.assertEqual(ticks, [1])
+
+
+class TestMemo(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.now = 0.0
+        self.exp = fatexpression.FatExpression()
+        self.memo = self.exp.addEvaluate(self.lookup, capacity=2)
+
+    def lookup(self, text, args):
+        if text == 'price':
+            self.calls.append(args[0])
+            return args[0] * 2
+
+    def test_hits(self):
+        self.exp.text = 'price(1)+price(1)+price(2)'
+        self.assertEqual(self.exp.value, 8)
+        self.assertEqual(self.exp.value, 8)
+        self.assertEqual(self.calls, [1, 2])
+        self.assertEqual(self.memo.stats(), {'size': 2, 'capacity': 2, 'hits': 4, 'misses': 2, 'evictions': 0})
+
+    def test_evict(self):
+        self.exp.text = 'price(1)+price(2)+price(3)+price(1)'
+        self.assertEqual(self.exp.value, 14)
+        self.assertEqual(self.calls, [1, 2, 3, 1])
+        self.assertEqual(self.memo.evictions, 2)
+
+    def test_invalidate(self):
+        self.exp.text = 'price(1)+price(2)'
+        self.exp.value
+        self.memo.invalidate('PRICE', [1])
+        self.assertEqual(self.exp.value, 6)
+        self.assertEqual(self.calls, [1, 2, 1])
+        self.memo.invalidate('price')
+        self.exp.value
+        self.assertEqual(self.calls, [1, 2, 1, 1, 2])
+        self.memo.invalidate()
+        self.assertEqual(len(self.memo), 0)
+
+    def test_ttl(self):
+        memo = fatexpression.ExpMemo(self.lookup, ttl=10, clock=lambda: self.now)
+        self.assertEqual(memo('price', [1]), 2)
+        self.now = 9
+        memo('price', [1])
+        self.now = 10
+        memo('price', [1])
+        self.assertEqual(self.calls, [1, 1])
+
+    def test_async(self):
+        async def lookup(text, args):
+            self.calls.append(args[0])
+            return args[0]
+        memo = fatexpression.ExpMemo(lookup)
+        self.assertEqual(asyncio.run(memo('price', [3])), 3)
+        self.assertEqual(memo('price', [3]), 3)
+        self.assertEqual(self.calls, [3])
+
+
+class TestPureFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.exp = fatexpression.FatExpression()
+        self.exp.addNative('rate', self.rate, 1)
+        self.exp.addFunctions(['tax(v)=if(v>100, v*rate(2), v*rate(1))', 'net(v)=v-tax(v)'], pure=True,
+                              capacity=2)
+        self.exp.text = 'net(200)+net(50)+net(200)'
+
+    def rate(self, value):
+        self.calls.append(value)
+        return value / 10.0
+
+    def test_cache(self):
+        self.assertEqual(self.exp.value, 200 - 40 + 50 - 5 + 200 - 40)
+        self.assertEqual(self.calls, [2, 1])
+        self.assertEqual(self.exp.functionStats()['net'], {'size': 2, 'capacity': 2, 'hits': 1, 'misses': 2,
+                                                            'evictions': 0})
+        self.assertEqual(self.exp.functionStats()['tax']['misses'], 2)
+
+    def test_modes(self):
+        expected = self.exp.value
+        for mode in (fatexpression.emCode, fatexpression.emProgram):
+            self.exp.evaluateMode = mode
+            self.assertEqual(self.exp.value, expected)
+        self.assertEqual(self.exp.compileExpression().evaluate(), expected)
+
+    def test_program(self):
+        self.exp.evaluateMode = fatexpression.emProgram
+        self.assertEqual(self.exp.value, 200 - 40 + 50 - 5 + 200 - 40)
+        self.assertEqual(self.calls, [2, 1])
+        self.assertEqual(self.exp.functionStats()['net']['hits'], 1)
+        self.assertEqual(self.exp.functionStats()['tax']['misses'], 2)
+
+    def test_impure(self):
+        for text in ['r(v)=v*random(1)', 'g(v)=v*c', 'o(v)=v+_', 'u(v)=v+unknown(v)', 'n(v)=x2(v)']:
+            exp = fatexpression.FatExpression()
+            exp.addFunctions(['x2(a)=a+c'])
+            exp.addVariables({'c':1})
+            exp.addEvaluate(processo)
+            exp.addFunctions([text], pure=True)
+            exp.text = '1'
+            self.assertRaises(Exception, getattr, exp, 'value')
+
+    def test_callbacks(self):
+        rates = {'rate': 1}
+        exp = fatexpression.FatExpression()
+        exp.addEvaluate(lambda text, args: rates.get(text), pure=True)
+        exp.addFunctions(['tax(v)=v*rate(1)'])
+        exp.text = 'tax(10)'
+        self.assertEqual(exp.value, 10)
+        rates['rate'] = 5
+        self.assertEqual(exp.value, 50)
+        exp.clearFunctions()
+        exp.addFunctions(['tax(v)=v*rate(1)'], pure=True)
+        self.assertRaises(Exception, getattr, exp, 'value')
+
+    def test_shadow(self):
+        self.exp.addFunctions(['root(v)=sqrt(v)'], pure=True)
+        self.exp.text = 'root(16)'
+        self.assertEqual(self.exp.value, 4)
+        self.exp.addVariables({'sqrt':1})
+        self.assertRaises(Exception, getattr, self.exp, 'value')
+
+
+class TestPack(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.fxp')
+        os.close(handle)
+        self.functions = ['x(a,b)=a*b', 'x2(a)=a', 'tax(v)=if(v>100, v*0.2, v*0.1)']
+        self.expressions = {'one': 'x(c,2)+tax(c*10)', 'two': 'k:x(c,x2(4));k+b+_', 'three': 'tax(d)'}
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def expected(self, name, order=fatexpression.eoInternalFirst, variables=None):
+        exp = fatexpression.FatExpression()
+        exp.addEvaluate(processo)
+        exp.addFunctions(self.functions)
+        exp.addVariables({'c':30, 'd':20})
+        exp.addVariables(variables or {})
+        exp.evaluateOrder = order
+        exp.text = self.expressions[name]
+        return exp.value
+
+    def test_roundtrip(self):
+        for order in (fatexpression.eoInternalFirst, fatexpression.eoEventFirst):
+            fatexpression.savePack(self.path, self.expressions, self.functions, {'c':30, 'd':20}, order,
+                                   optimize=True)
+            pack = fatexpression.loadPack(self.path)
+            pack.addEvaluate(processo)
+            self.assertEqual(sorted(pack.names()), ['one', 'three', 'two'])
+            for name in self.expressions:
+                self.assertEqual(pack.evaluate(name), self.expected(name, order))
+                self.assertEqual(pack.evaluate(name, {'d':500}), self.expected(name, order, {'d':500}))
+            self.assertTrue(isinstance(pack.program('one').code, memoryview))
+            self.assertRaises(Exception, pack.evaluate, 'four')
+
+    def test_shared_functions(self):
+        fatexpression.savePack(self.path, {'a': 'tax(c)', 'b': 'tax(d)+1'}, self.functions, {'c':1, 'd':2})
+        pack = fatexpression.loadPack(self.path)
+        self.assertTrue(pack.program('a').functions[0] is pack.program('b').functions[0])
+
+    def test_checks(self):
+        fatexpression.savePack(self.path, self.expressions, self.functions)
+        with open(self.path, 'rb') as file:
+            data = bytearray(file.read())
+
+        def check(data, message):
+            with open(self.path, 'wb') as file:
+                file.write(data)
+            with self.assertRaises(Exception) as context:
+                fatexpression.loadPack(self.path)
+            self.assertTrue(message in str(context.exception))
+
+        corrupt = bytearray(data)
+        corrupt[-2] ^= 1
+        check(corrupt, 'checksum')
+        version = bytearray(data)
+        version[4] += 1
+        check(version, 'version')
+        check(b'not a pack' + bytes(30), 'not a rule pack')
+        check(b'', 'not a rule pack')
+        check(b'FXP', 'not a rule pack')
+
+
+class TestRuleSet(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.rules = fatexpression.RuleSet({
+            'risk': 'sqrt(amount^2+fee^2)*score(1)',
+            'limit': 'if(sqrt(amount^2+fee^2)>100, 1, 0)',
+            'total': 'x(amount, 2)+fee',
+            'again': 'x(amount, 2)+fee',
+            'plain': 'fee*2',
+        })
+        self.rules.addFunctions(['x(a,b)=a*b'])
+        self.rules.addVariables({'fee': 10})
+        self.rules.addEvaluate(self.score, pure=True)
+
+    def score(self, text, args):
+        if text == 'score':
+            self.calls.append(args[0])
+            return 0.5
+
+    def test_evaluate(self):
+        hyp = math.sqrt(200 ** 2 + 10 ** 2)
+        results = self.rules.evaluate({'amount': 200})
+        self.assertEqual(results, {'risk': hyp * 0.5, 'limit': 1, 'total': 410, 'again': 410, 'plain': 20})
+        self.assertEqual(list(results), self.rules.names())
+        self.assertEqual(self.rules.shared, 2)
+        self.assertEqual(self.rules.evaluate({'amount': 0, 'fee': 1})['total'], 1)
+        self.assertEqual(self.calls, [1, 1])
+
+    def test_subset(self):
+        self.assertEqual(self.rules.evaluate({'amount': 3}, ['limit', 'again']), {'limit': 0, 'again': 16})
+        self.assertEqual(self.rules.evaluate({'amount': 3}, ['plain']), {'plain': 20})
+        self.assertEqual(self.calls, [])
+        self.assertRaises(Exception, self.rules.evaluate, {}, ['other'])
+
+    def test_rules(self):
+        self.assertRaises(Exception, self.rules.addRules, {'a': 'k:1'})
+        self.assertRaises(Exception, self.rules.addRules, {'a': '1;2'})
+        self.assertRaises(Exception, self.rules.addRules, {'a': '_+1'})
+        self.assertRaises(Exception, self.rules.addRules, {'plain': '1'})
+        self.rules.addRules({'new': 'fee+1'})
+        self.assertEqual(self.rules.evaluate({'amount': 1}, ['new']), {'new': 11})
+        self.assertEqual(len(self.rules), 6)
+
+    def test_rules_invalid(self):
+        self.assertEqual(self.rules.evaluate({'amount': 1})['plain'], 20)
+        self.assertRaises(Exception, self.rules.addRules, {'new': 'fee*3', 'plain': '5'})
+        self.assertRaises(Exception, self.rules.addRules, {'new': 'fee*3', 'bad': '_'})
+        self.assertEqual(self.rules.names(), ['risk', 'limit', 'total', 'again', 'plain'])
+        self.assertRaises(Exception, self.rules.evaluate, {}, ['new'])
+        self.rules.addRules({'new': 'fee*3'})
+        self.assertEqual(self.rules.evaluate({'amount': 1}, ['new']), {'new': 30})
+
+
+class TestCommandLine(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def runMain(self, name, text, *args):
+        source = os.path.join(self.directory, name)
+        target = os.path.join(self.directory, 'out' + os.path.splitext(name)[1])
+        with open(source, 'w') as file:
+            file.write(text)
+        code = fatexpression.main([source, '-o', target] + list(args))
+        with open(target) as file:
+            return code, file.read()
+
+    def test_csv(self):
+        code, text = self.runMain('in.csv', 'id,price,qty\n1,10,3\n2,2.5,4\n',
+                                   '-e', 'total', 'x(price,qty)', '-e', 'taxed', 'k:_+price*qty;k*t',
+                                   '-f', 'x(a,b)=a*b', '-v', 't=2')
+        self.assertEqual(code, 0)
+        self.assertEqual(text.splitlines(), ['id,price,qty,total,taxed', '1,10,3,30.0,60.0', '2,2.5,4,10.0,20.0'])
+
+    def test_jsonl(self):
+        code, text = self.runMain('in.jsonl', '{"a": 1, "s": "x"}\n\n{"a": 2.5}\n', '-e', 'y', 'a*2')
+        self.assertEqual(code, 0)
+        self.assertEqual([json.loads(line) for line in text.splitlines()],
+                         [{'a': 1, 's': 'x', 'y': 2.0}, {'a': 2.5, 'y': 5.0}])
+
+    def test_errors(self):
+        stderr = sys.stderr
+        sys.stderr = io.StringIO()
+        try:
+            code, text = self.runMain('in.csv', 'a\n1\nx\n2\n', '-e', 'y', 'a+1')
+            self.assertEqual((code, text.splitlines()), (1, ['a,y', '1,2.0']))
+            code, text = self.runMain('in.csv', 'a\n1\nx\n2\n', '-e', 'y', 'a+1', '--keep-going')
+            self.assertEqual((code, text.splitlines()), (0, ['a,y', '1,2.0', 'x,', '2,3.0']))
+            self.assertTrue('record 2, y' in sys.stderr.getvalue())
+            missing = os.path.join(self.directory, 'missing.csv')
+            self.assertEqual(fatexpression.main([missing, '-e', 'y', 'a+1']), 1)
+            self.assertEqual(fatexpression.main([missing, '-e', 'y', 'a+']), 1)
+            self.assertTrue('fatexpression: y: ' in sys.stderr.getvalue())
+            self.assertEqual(fatexpression.main([missing, '-e', 'y', 'a', '-f', 'f(a)=']), 1)
+        finally:
+            sys.stderr = stderr
+
+    def test_module(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run([sys.executable, '-m', 'fatexpression', '--format', 'jsonl', '-e', 'y', 'a^2'],
+                                input='{"a": 3}\n', stdout=subprocess.PIPE, cwd=root, universal_newlines=True)
+        self.assertEqual(result.stdout, '{"a": 3, "y": 9.0}\n')
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file